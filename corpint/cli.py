@@ -6,19 +6,29 @@ from itertools import combinations
 from unicodecsv import DictReader, DictWriter
 
 from corpint.core import config, project, session
-from corpint.model import Mapping, Entity
+from corpint.model import Mapping, Entity, EnrichmentState
+from corpint.model.scoring import compare_pairs
+from corpint.model.upgrade import upgrade_database
 from corpint.webui import run_webui
-from corpint.export import export_to_neo4j
+from corpint.export import export_to_neo4j, export_to_neo4j_csv
+from corpint.export import sync_to_neo4j, export_to_parquet
 from corpint.enrich import get_enrichers
+from corpint.enrich.runner import run_enrichment
+from corpint.enrich.cache import get_cache
+from corpint.enrich.scheduler import log_metrics
+from corpint.enrich.geocode import get_geocoder, geocode_addresses
 
 
 @click.group()
 @click.option('--debug/--no-debug', default=False)
 @click.option('database_uri', '--db', envvar='DATABASE_URI')
 @click.option('name', '--project', envvar='CORPINT_PROJECT')
-def cli(debug, database_uri, name):
+@click.option('--offline/--online', default=None)
+def cli(debug, database_uri, name, offline):
     """An investigative graph data assembly toolkit."""
     config.debug = debug
+    if offline is not None:
+        config.offline = offline
     config.database_uri = database_uri
     config.project_name = name
 
@@ -31,15 +41,30 @@ def mappings():
 @mappings.command('generate')
 @click.option('threshold', '--threshold', '-t', type=float, default=0.5)
 @click.option('origins', '--origin', '-o', multiple=True)
-def mappings_generate(threshold, origins):
+@click.option('blockers', '--blocker', '-b', multiple=True)
+@click.option('max_block_size', '--block-size', type=int, default=200)
+@click.option('--engine', type=click.Choice(['blocking', 'index']),
+              default='blocking')
+@click.option('workers', '--workers', '-w', type=int, default=1)
+def mappings_generate(threshold, origins, blockers, max_block_size, engine,
+                      workers):
     """Compare all entities and generate candidates."""
-    Mapping.generate_scored_mappings(origins=origins, threshold=threshold)
+    if engine == 'index':
+        Mapping.generate_indexed_mappings(origins=origins,
+                                          threshold=threshold)
+        return
+    Mapping.generate_scored_mappings(origins=origins, threshold=threshold,
+                                     blockers=blockers,
+                                     max_block_size=max_block_size,
+                                     workers=workers)
 
 
 @mappings.command('apply')
-def mappings_apply():
+@click.option('--rebuild/--no-rebuild', default=False)
+@click.option('--force/--no-force', default=False)
+def mappings_apply(rebuild, force):
     """Apply mapped canonical IDs to all entities."""
-    Mapping.canonicalize()
+    Mapping.canonicalize(rebuild=rebuild, force=force)
     session.commit()
 
 
@@ -69,15 +94,21 @@ def mappings_export(file, decided):
 @click.argument('file', type=click.File('rb'))
 def mappings_import(file):
     """Load decided mappings from a CSV file."""
+    rows, unjudged = [], []
     for row in DictReader(file):
-        left_uid = row.get('left')
-        right_uid = row.get('right')
         judgement = parse_boolean(row.get('judgement'), default=None)
+        rows.append((row.get('left'), row.get('right'), judgement))
+        if judgement is None:
+            left = Entity.get(row.get('left'))
+            right = Entity.get(row.get('right'))
+            unjudged.append((left.features, right.features))
+
+    # Score the pairs without a judgement all at once.
+    scores = iter(compare_pairs(unjudged))
+    for left_uid, right_uid, judgement in rows:
         score = None
         if judgement is None:
-            left = Entity.get(left_uid)
-            right = Entity.get(right_uid)
-            score = left.compare(right)
+            score = float(next(scores))
         project.emit_judgement(left_uid, right_uid, judgement,
                                score=score, decided=True)
 
@@ -109,16 +140,43 @@ def webui():
 
 @cli.command('enrich')
 @click.option('origins', '--origin', '-o', multiple=True)
+@click.option('concurrency', '--concurrency', '-c', type=int, default=1)
+@click.option('--force/--no-force', default=False)
+@click.option('max_age', '--max-age', type=float, default=None)
 @click.argument('enricher')
-def enrich(origins, enricher):
+def enrich(origins, concurrency, force, max_age, enricher):
     """Cross-reference against external APIs."""
     enrich_func = get_enrichers().get(enricher)
     if enrich_func is None:
         raise RuntimeError("Enricher not found: %s" % enricher)
+    # One database connection per worker, plus the streaming reader.
+    config.pool_size = max(5, concurrency + 2)
+    config.http_pool_size = max(config.http_pool_size, concurrency)
     emitter = project.origin(enricher)
     Mapping.canonicalize()
-    for entity in Entity.iter_composite(origins=origins, tasked=True):
-        enrich_func(emitter, entity)
+    session.commit()
+    state = EnrichmentState(enricher, force=force, max_age=max_age)
+    entities = Entity.iter_composite(origins=origins, tasked=True, rows=True)
+    try:
+        run_enrichment(enrich_func, emitter, entities,
+                       concurrency=concurrency, state=state)
+    finally:
+        get_cache().log_stats()
+        log_metrics()
+
+
+@cli.command('geocode')
+@click.option('backend', '--backend', '-b', default='gmaps')
+@click.option('--retry/--no-retry', default=False)
+def geocode(backend, retry):
+    """Geocode each distinct address once."""
+    geocode_addresses(get_geocoder(backend), retry=retry)
+
+
+@cli.command()
+def upgrade():
+    """Upgrade an older database, removing duplicate entities."""
+    upgrade_database(session.get_bind(), dedupe=True)
 
 
 @cli.command()
@@ -136,11 +194,32 @@ def export():
 @export.command('neo4j')
 @click.option('neo4j_uri', '--url', '-u', default=None)
 @click.option('--decided/--undecided', default=True)
-def export_neo4j(neo4j_uri, decided):
+@click.option('chunk_size', '--chunk-size', type=int, default=5000)
+@click.option('--sync/--reload', default=False)
+def export_neo4j(neo4j_uri, decided, chunk_size, sync):
     """Load the graph to Neo4J for navigation."""
     if neo4j_uri is not None:
         config.neo4j_uri = neo4j_uri
-    export_to_neo4j(decided)
+    if sync:
+        sync_to_neo4j(decided, chunk_size=chunk_size)
+    else:
+        export_to_neo4j(decided, chunk_size=chunk_size)
+
+
+@export.command('neo4j-csv')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--decided/--undecided', default=True)
+def export_neo4j_csv(directory, decided):
+    """Write the graph as CSV files for neo4j-admin import."""
+    export_to_neo4j_csv(directory, decided)
+
+
+@export.command('parquet')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('chunk_size', '--chunk-size', type=int, default=50000)
+def export_parquet(directory, chunk_size):
+    """Write entities, links and mappings as Parquet tables."""
+    export_to_parquet(directory, chunk_size=chunk_size)
 
 
 def main():
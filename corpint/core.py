@@ -1,6 +1,7 @@
 import logging
 import requests
-from os import environ
+from os import environ, path
+from dalet import parse_boolean
 from werkzeug.local import LocalProxy
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
@@ -17,6 +18,20 @@ class Config():
     project_name = environ.get('CORPINT_PROJECT', 'default')
     database_uri = environ.get('DATABASE_URI')
     neo4j_uri = environ.get('NEO4J_URI')
+    pool_size = None
+    data_path = environ.get('CORPINT_DATA_PATH',
+                            path.expanduser('~/.corpint'))
+    cache_path = environ.get('CORPINT_HTTP_CACHE',
+                             path.join(data_path, 'http-cache.sqlite3'))
+    cache_size = int(environ.get('CORPINT_HTTP_CACHE_SIZE', 1024 ** 3))
+    offline = parse_boolean(environ.get('CORPINT_OFFLINE'), default=False)
+    http_pool_size = int(environ.get('CORPINT_HTTP_POOL_SIZE', 10))
+    http_timeout = float(environ.get('CORPINT_HTTP_TIMEOUT', 60))
+    http_verify = parse_boolean(environ.get('CORPINT_HTTP_VERIFY'),
+                                default=False)
+    http_retries = int(environ.get('CORPINT_HTTP_RETRIES', 5))
+    http_backoff = float(environ.get('CORPINT_HTTP_BACKOFF', 1.0))
+    http_max_backoff = float(environ.get('CORPINT_HTTP_MAX_BACKOFF', 60))
 
 
 config = Config()
@@ -32,7 +47,8 @@ def get_project():
 def get_session():
     if not hasattr(config, 'session'):
         from corpint.model import create_session
-        config.session = create_session(config.database_uri)
+        config.session = create_session(config.database_uri,
+                                        pool_size=config.pool_size)
     return config.session
 
 
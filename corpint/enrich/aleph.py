@@ -1,17 +1,19 @@
 import logging
-import requests
-from time import sleep
+import threading
 from os import environ
 from normality import latinize_text
 from pprint import pprint  # noqa
 from urlparse import urljoin
-from itertools import count
+from multiprocessing.pool import ThreadPool
 
 from corpint.core import session
+from corpint.enrich.client import get_session
+from corpint.enrich.scheduler import TransientError
 from corpint.model.schema import COMPANY, ORGANIZATION, PERSON, ASSET, OTHER
 from corpint.model import Document
 
 log = logging.getLogger(__name__)
+lock = threading.Lock()
 
 API_KEY = environ.get('ALEPH_APIKEY')
 HOST = environ.get('ALEPH_HOST', 'https://data.occrp.org')
@@ -21,6 +23,9 @@ COLLECTIONS_API = urljoin(HOST, 'api/1/collections')
 COLLECTIONS = {}
 DATASETS_API = urljoin(HOST, 'api/1/datasets')
 DATASETS = {}
+CRAWL_CONCURRENCY = int(environ.get('ALEPH_CRAWL_CONCURRENCY', 8))
+LINKS_PAGE = 50
+POOL = None
 STOPWORDS = ['mr ', 'mr. ', 'ms ', 'ms. ', 'mrs ', 'mrs. ', 'the ', 'a ']
 
 ENTITY_PROPERTIES = {
@@ -119,13 +124,14 @@ def aleph_api(url, params=None):
     if API_KEY is not None:
         params['api_key'] = API_KEY
 
-    for i in count(2):
-        try:
-            res = requests.get(url, params=params, verify=False)
-            return res.json()
-        except Exception as ex:
-            log.exception(ex)
-            sleep(i ** 2)
+    res = get_session('aleph').get(url, params=params)
+    if res.status_code == 404:
+        log.warning("Aleph API not found: %s", url)
+        return None
+    if res.status_code != 200:
+        raise TransientError("Aleph API error [%s]: %s" %
+                             (res.status_code, url))
+    return res.json()
 
 
 def aleph_paged(url, params=None, limit=None):
@@ -158,42 +164,108 @@ def map_properties(obj, mapping):
     return data
 
 
-def emit_entity(emitter, entity, links=True):
-    # Skip collection stuff for now.
-    if entity.get('dataset') is None:
-        return
+def links_page(task):
+    aleph_id, offset = task
+    url = '%s/%s/links' % (ENTITIES_API, aleph_id)
+    return aleph_api(url, params={'limit': LINKS_PAGE, 'offset': offset})
+
+
+def get_pool():
+    global POOL
+    with lock:
+        if POOL is None:
+            POOL = ThreadPool(CRAWL_CONCURRENCY)
+    return POOL
+
+
+class LinkCrawler(object):
+    """Emit an Aleph entity and the entities linked to it. The links of
+    assets are followed further. Link pages are fetched in parallel, one
+    level of the link graph at a time, and each remote entity is only
+    emitted once per crawl."""
+
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.uids = {}
+        self.types = {}
+
+    def add_entity(self, entity):
+        aleph_id = entity.get('id')
+        if aleph_id in self.uids:
+            return self.uids[aleph_id]
+        self.uids[aleph_id] = None
+        # Skip collection stuff for now.
+        if entity.get('dataset') is None:
+            return
+        entity_uid = self.emitter.uid(aleph_id)
+        if entity_uid is None:
+            return
+        data = {
+            'aleph_id': '%s:%s' % (entity.get('dataset'), aleph_id),
+            'uid': entity_uid,
+            'publisher': dataset_label(entity.get('dataset')),
+            'name': entity.get('name')
+        }
+        data.update(map_properties(entity, ENTITY_PROPERTIES))
+        data['type'] = TYPE_MAPPING.get(entity.get('schema'))
+        self.emitter.log.info("[%(dataset)s]: %(name)s", entity)
+        self.emitter.emit_entity(data)
+        self.uids[aleph_id] = entity_uid
+        self.types[aleph_id] = data['type']
+        return entity_uid
+
+    def add_link(self, entity_uid, other_uid, link):
+        ldata = {
+            'source_uid': other_uid if link['inverted'] else entity_uid,
+            'target_uid': entity_uid if link['inverted'] else other_uid,
+        }
+        ldata.update(map_properties(link, LINK_PROPERTIES))
+        ldata.pop('aliases')
+        self.emitter.emit_link(ldata)
+
+    def fetch_links(self, aleph_ids):
+        """Get the links of each of the given entities. The first pages
+        are fetched in parallel, and then all the remaining ones."""
+        pool = get_pool()
+        tasks = [(aleph_id, 0) for aleph_id in aleph_ids]
+        links = {}
+        more = []
+        for (aleph_id, _), data in zip(tasks, pool.map(links_page, tasks)):
+            data = data or {}
+            links[aleph_id] = list(data.get('results', []))
+            total = data.get('total', 0)
+            for offset in range(LINKS_PAGE, total, LINKS_PAGE):
+                more.append((aleph_id, offset))
+        for (aleph_id, _), data in zip(more, pool.map(links_page, more)):
+            if data is not None:
+                links[aleph_id].extend(data.get('results', []))
+        return links
+
+    def crawl(self, entity, links=True):
+        entity_uid = self.add_entity(entity)
+        if entity_uid is None or not links:
+            return entity_uid
+        level = [entity.get('id')]
+        while len(level):
+            pages = self.fetch_links(level)
+            expand = []
+            for aleph_id in level:
+                follow = self.types.get(aleph_id) == ASSET
+                for link in pages[aleph_id]:
+                    remote = link.get('remote')
+                    seen = remote.get('id') in self.uids
+                    other_uid = self.add_entity(remote)
+                    if other_uid is None:
+                        continue
+                    self.add_link(self.uids[aleph_id], other_uid, link)
+                    if follow and not seen:
+                        expand.append(remote.get('id'))
+            level = expand
+        return entity_uid
 
-    entity_uid = emitter.uid(entity.get('id'))
-    if entity_uid is None:
-        return
-    data = {
-        'aleph_id': '%s:%s' % (entity.get('dataset'), entity.get('id')),
-        'uid': entity_uid,
-        'publisher': dataset_label(entity.get('dataset')),
-        'name': entity.get('name')
-    }
-    data.update(map_properties(entity, ENTITY_PROPERTIES))
-    data['type'] = TYPE_MAPPING.get(entity.get('schema'))
-    emitter.log.info("[%(dataset)s]: %(name)s", entity)
-
-    if links:
-        links_url = '%s/%s/links' % (ENTITIES_API, entity.get('id'))
-        for link in aleph_paged(links_url):
-            remote = link.get('remote')
-            links = data.get('type') == ASSET
-            other_uid = emit_entity(emitter, remote, links=links)
-            if other_uid is None:
-                continue
-            ldata = {
-                'source_uid': other_uid if link['inverted'] else entity_uid,
-                'target_uid': entity_uid if link['inverted'] else other_uid,
-            }
-            ldata.update(map_properties(link, LINK_PROPERTIES))
-            ldata.pop('aliases')
-            emitter.emit_link(ldata)
 
-    emitter.emit_entity(data)
-    return entity_uid
+def emit_entity(emitter, entity, links=True):
+    return LinkCrawler(emitter).crawl(entity, links=links)
 
 
 # def get_entity(origin, entity_id):
@@ -207,7 +279,7 @@ def emit_entity(emitter, entity, links=True):
 
 def enrich(origin, entity):
     if entity.schema not in [PERSON, OTHER, ORGANIZATION, COMPANY]:
-        return
+        return True
 
     names = set()
     for name in entity.names:
@@ -219,12 +291,14 @@ def enrich(origin, entity):
         names.add(term)
 
     query = ' OR '.join(names)
-    for match in aleph_paged(ENTITIES_API, params={'q': query}):
-        match_uid = origin.uid(match.get('id'))
-        if match_uid is None:
-            continue
-        emitter = origin.result(entity.uid, match_uid)
-        emit_entity(emitter, match)
+    with origin.batch() as batch:
+        for match in aleph_paged(ENTITIES_API, params={'q': query}):
+            match_uid = origin.uid(match.get('id'))
+            if match_uid is None:
+                continue
+            emitter = batch.result(entity.uid, match_uid)
+            emit_entity(emitter, match)
+    return True
 
 
 def search_documents(query):
@@ -244,7 +318,7 @@ def enrich_documents(origin, entity):
     session.commit()
 
     if entity.schema not in [PERSON, COMPANY, ORGANIZATION, OTHER]:
-        return
+        return True
 
     total = 0
     query = search_entity(entity)
@@ -252,3 +326,4 @@ def enrich_documents(origin, entity):
         origin.emit_document(entity.uid, url, title, publisher=publisher)
         total += 1
     origin.log.info('Query [%s]: %s -> %s', entity.name, query, total)
+    return True
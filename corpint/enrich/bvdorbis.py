@@ -1,15 +1,36 @@
-from os import environ
+import atexit
+import logging
+import threading
+from time import time
+from os import environ, path, makedirs
+from Queue import Queue, Empty
+from contextlib import contextmanager
 from lxml import etree
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from pprint import pprint  # noqa
 import zeep
-from zeep.exceptions import TransportError
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+from zeep.exceptions import TransportError, Fault
 
+from corpint.core import config
+from corpint.enrich.runner import EnrichmentSkipped
+from corpint.enrich.scheduler import TransientError
 from corpint.model.schema import PERSON, COMPANY, ORGANIZATION, OTHER
 
+log = logging.getLogger(__name__)
+lock = threading.Lock()
+
 WSDL = 'https://webservices.bvdep.com/orbis/remoteaccess.asmx?WSDL'
+WSDL_CACHE_TTL = 86400 * 7
 USERNAME = environ.get('ORBIS_USERNAME', 'occrp_ws')
 PASSWORD = environ.get('ORBIS_PASSWORD')
+# Number of Orbis sessions kept open, and their lifetime in seconds.
+SESSIONS = int(environ.get('ORBIS_SESSIONS', 4))
+SESSION_TTL = int(environ.get('ORBIS_SESSION_TTL', 1200))
+POOL = None
+CHUNK_SIZE = 65536
 
 FIELD_MAPPING = {
     'STATUS': 'status',
@@ -88,50 +109,165 @@ TYPES = {
 }
 
 
+def local_name(el):
+    if not isinstance(el.tag, basestring):
+        return
+    return etree.QName(el).localname
+
+
+def iter_records(res):
+    """Parse the records of an XML payload incrementally, feeding it to
+    the parser in chunks and discarding each record once it is used."""
+    parser = etree.XMLPullParser(events=('end',))
+    for offset in range(0, len(res), CHUNK_SIZE):
+        chunk = res[offset:offset + CHUNK_SIZE]
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        parser.feed(chunk)
+        for record in read_records(parser):
+            yield record
+    parser.close()
+    for record in read_records(parser):
+        yield record
+
+
+def read_records(parser):
+    for _, el in parser.read_events():
+        if local_name(el) != 'record':
+            continue
+        yield el
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
 def parse_xml(res):
-    res = res.replace('xmlns="', 'xmlnons="')
-    doc = etree.fromstring(res.encode('utf-8'))
-
-    # for record in doc.findall('.//record'):
-    #     UNKNOWN = defaultdict(list)
-    #     items = defaultdict(list)
-    #     for item in record.findall('./item'):
-    #         field = item.get('field')
-    #         prop = FIELD_MAPPING.get(field)
-    #         if prop is not None:
-    #             continue
-    #         if item.text and len(item.text.strip()):
-    #             print field, item.text.strip()
-    #         for child in item.findall('./childItem'):
-    #             if child.text and len(child.text.strip()):
-    #                 print field, child.text.strip()
-    #     pprint(dict(UNKNOWN))
-
-    for record in doc.findall('.//record'):
+    """Yield the mapped items of each record, once for the record and
+    once for each index of its child items."""
+    if res is None:
+        return
+    for record in iter_records(res):
         items = defaultdict(list)
-        for item in record.findall('./item'):
+        for item in record.iterchildren():
+            if local_name(item) != 'item':
+                continue
             prop = FIELD_MAPPING.get(item.get('field'))
             if prop is None:
                 continue
             if item.text and len(item.text.strip()):
                 items[0].append((prop, item.text))
-            for child in item.findall('./childItem'):
-                index = child.get('index')
-                items[index].append((prop, child.text))
-        return items.values()
-    return []
+            for child in item.iterchildren():
+                if local_name(child) == 'childItem':
+                    items[child.get('index')].append((prop, child.text))
+        for values in items.values():
+            yield values
+
+
+class OrbisSession(object):
+    """An Orbis session which is re-opened when it has expired."""
+
+    def __init__(self, client):
+        self.client = client
+        self.token = None
+        self.opened_at = None
+
+    @property
+    def expired(self):
+        return self.token is None or time() - self.opened_at > SESSION_TTL
+
+    def open(self):
+        self.close()
+        self.token = self.client.service.Open(USERNAME, PASSWORD)
+        self.opened_at = time()
+        log.info('Orbis session: %s', self.token)
+
+    def close(self):
+        if self.token is not None:
+            try:
+                self.client.service.Close(self.token)
+            except (Fault, TransportError) as ex:
+                log.warning('Could not close Orbis session: %s', ex)
+        self.token = None
+
+    def call(self, method, *args):
+        if self.expired:
+            self.open()
+        try:
+            return getattr(self.client.service, method)(self.token, *args)
+        except Fault as fault:
+            if 'session' not in unicode(fault.message).lower():
+                raise
+            log.info('Orbis session expired: %s', fault.message)
+            self.open()
+            return getattr(self.client.service, method)(self.token, *args)
 
 
-def get_list_data(client, session, res, format):
-    res = client.service.GetListData(session, res, 0, 2000, format,
-                                     'XML_UTF8')
-    return parse_xml(res)
+class OrbisPool(object):
+    """A pool of long-lived Orbis sessions, sharing one SOAP client with a
+    cached WSDL."""
 
+    def __init__(self, size=SESSIONS):
+        cache_path = path.join(config.data_path, 'orbis-wsdl.sqlite3')
+        if not path.isdir(config.data_path):
+            makedirs(config.data_path)
+        cache = SqliteCache(path=cache_path, timeout=WSDL_CACHE_TTL)
+        self.client = zeep.Client(wsdl=WSDL,
+                                  transport=Transport(cache=cache))
+        self.idle = Queue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.threads = ThreadPool(size)
 
-def get_section(client, session, res, section):
-    res = client.service.GetReportSection(session, res, 0, 2000,
-                                          section, 'USD', 'XML_UTF8')
-    return parse_xml(res)
+    @contextmanager
+    def session(self):
+        with self.slots:
+            try:
+                session = self.idle.get_nowait()
+            except Empty:
+                session = OrbisSession(self.client)
+            try:
+                yield session
+            finally:
+                self.idle.put(session)
+
+    def call(self, method, *args):
+        with self.session() as session:
+            return session.call(method, *args)
+
+    def fetch(self, calls):
+        """Run ``(func, args)`` calls concurrently, each with a session
+        from the pool, and return their results in order."""
+        def run(call):
+            func, args = call
+            with self.session() as session:
+                return func(session, *args)
+        return self.threads.map(run, calls)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+
+def get_pool():
+    global POOL
+    with lock:
+        if POOL is None:
+            POOL = OrbisPool()
+            atexit.register(POOL.close)
+    return POOL
+
+
+def get_list_data(session, res, format):
+    res = session.call('GetListData', res, 0, 2000, format, 'XML_UTF8')
+    return list(parse_xml(res))
+
+
+def get_section(session, res, section):
+    res = session.call('GetReportSection', res, 0, 2000, section, 'USD',
+                       'XML_UTF8')
+    return list(parse_xml(res))
 
 
 def link_items(emitter, entity, items, summary):
@@ -163,7 +299,7 @@ def link_items(emitter, entity, items, summary):
     emitter.emit_link(link)
 
 
-def emit_company(emitter, client, session, data):
+def emit_company(emitter, pool, data):
     if data.Hint in ['UnlikelyCandidate']:
         return
     entity = {
@@ -179,10 +315,23 @@ def emit_company(emitter, client, session, data):
     if data.NameInLocalAlphabet:
         entity['aliases'].add(data.NameInLocalAlphabet)
 
-    SelectionResult = client.get_type('ns0:SelectionResult')
+    SelectionResult = pool.client.get_type('ns0:SelectionResult')
     res = SelectionResult(Token='BVDID{%s}' % data.BvDID, SelectionCount=1)
 
-    for item in get_section(client, session, res, 'STATUS'):
+    # FIXME: for some reason the orbis API will not return directors sections.
+    # this workaround is dependent on setting up a specific list type, called
+    # directors, in your orbis account.
+    status, controlling, current, history, directors, subsidiaries = \
+        pool.fetch([
+            (get_section, (res, 'STATUS')),
+            (get_section, (res, 'CONTROLLINGSHAREHOLDERS')),
+            (get_section, (res, 'CURRENTSHAREHOLDERS')),
+            (get_section, (res, 'SHAREHOLDERSHISTORY')),
+            (get_list_data, (res, 'Directors')),
+            (get_section, (res, 'CURRENTSUBSIDIARIES')),
+        ])
+
+    for item in status:
         for key, value in item:
             if key in ['aliases']:
                 entity[key].add(value)
@@ -192,50 +341,45 @@ def emit_company(emitter, client, session, data):
     emitter.log.info("Company [%(bvd_id)s]: %(name)s", entity)
     emitter.emit_entity(entity)
 
-    for section in ['CONTROLLINGSHAREHOLDERS', 'CURRENTSHAREHOLDERS',
-                    'SHAREHOLDERSHISTORY']:
-        for item in get_section(client, session, res, section):
+    for section, items in [('CONTROLLINGSHAREHOLDERS', controlling),
+                           ('CURRENTSHAREHOLDERS', current),
+                           ('SHAREHOLDERSHISTORY', history)]:
+        for item in items:
             link_items(emitter, entity, item, section)
 
     # for section in ['CONTACTS_CURR', 'CONTACTS_PREV']:
     #     for item in get_section(client, session, res, section):
     #         pprint(item)
 
-    # FIXME: for some reason the orbis API will not return directors sections.
-    # this workaround is dependent on setting up a specific list type, called
-    # directors, in your orbis account.
-    for item in get_list_data(client, session, res, 'Directors'):
+    for item in directors:
         link_items(emitter, entity, item, 'Contact')
 
-    for item in get_section(client, session, res, 'CURRENTSUBSIDIARIES'):
+    for item in subsidiaries:
         link_items(emitter, entity, item, 'Subsidiary')
 
 
 def enrich(origin, entity):
     if entity.schema not in [OTHER, ORGANIZATION, COMPANY]:
         origin.log.info('Orbis skip: %s', entity.name)
-        return
+        return True
 
     if PASSWORD is None:
-        origin.log.warning('$ORBIS_PASSWORD not set, skipping BvD Orbis.')
-        return
+        raise EnrichmentSkipped('$ORBIS_PASSWORD not set.')
 
-    client = zeep.Client(wsdl=WSDL)
-    session = client.service.Open(USERNAME, PASSWORD)
-    origin.log.info('Session [%s]: %s', session, entity.name)
+    pool = get_pool()
+    origin.log.info('Orbis match: %s', entity.name)
     try:
         # print client.service.GetReportSectionIds(session)
         # print client.service.GetAvailableModels(session)
 
-        MatchCriteria = client.get_type('ns0:MatchCriteria')
+        MatchCriteria = pool.client.get_type('ns0:MatchCriteria')
         ct = MatchCriteria(Name=entity.name, Country=entity.country)
-        res = client.service.Match(session, ct, ['None'])
+        res = pool.call('Match', ct, ['None'])
         if res is not None:
             for data in res:
                 match_uid = origin.uid(data.BvDID)
                 emitter = origin.result(entity.uid, match_uid)
-                emit_company(emitter, client, session, data)
+                emit_company(emitter, pool, data)
+        return True
     except TransportError as terr:
-        origin.log.exception(terr)
-    finally:
-        client.service.Close(session)
+        raise TransientError("Orbis API error: %s" % terr)
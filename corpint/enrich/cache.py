@@ -0,0 +1,222 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from time import time
+from hashlib import sha1
+from collections import defaultdict
+from urlparse import urlsplit, urlunsplit, parse_qsl
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from corpint.core import config
+
+log = logging.getLogger(__name__)
+lock = threading.Lock()
+
+DAY = 86400
+DEFAULT_TTL = 7 * DAY
+TTLS = {
+    'aleph': 7 * DAY,
+    'opencorporates': 30 * DAY,
+    'wikidata': 14 * DAY,
+    'wikipedia': 14 * DAY,
+}
+# Credentials are never part of the cache key.
+STRIP_PARAMS = ['api_key', 'api_token', 'key', 'apikey']
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode for requests which are not cached."""
+
+
+def get_ttl(enricher):
+    """Cache lifetime for an enricher, in seconds. Can be set in days
+    with e.g. ``CORPINT_CACHE_TTL_ALEPH``."""
+    ttl = os.environ.get('CORPINT_CACHE_TTL_%s' % enricher.upper())
+    if ttl is not None:
+        return float(ttl) * DAY
+    return TTLS.get(enricher, DEFAULT_TTL)
+
+
+def normalize_params(params):
+    items = []
+    if isinstance(params, dict):
+        params = params.items()
+    for key, values in params or []:
+        if key in STRIP_PARAMS:
+            continue
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        for value in values:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            items.append((key, str(value)))
+    return sorted(items)
+
+
+def cache_key(method, url, params=None):
+    """Key a request on method, URL and the sorted query parameters,
+    without any credentials."""
+    scheme, netloc, path, query, _ = urlsplit(url)
+    params = normalize_params(params) + normalize_params(parse_qsl(query))
+    base = urlunsplit((scheme, netloc, path, '', ''))
+    key = json.dumps([method.upper(), base, sorted(params)])
+    return sha1(key).hexdigest()
+
+
+class ResponseCache(object):
+    """An on-disk, size-bounded store of HTTP responses in SQLite. The
+    least recently used responses are evicted first."""
+
+    def __init__(self, path, max_size=1024 ** 3, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+        self.local = threading.local()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.writes = 0
+        dir_name = os.path.dirname(path)
+        if len(dir_name) and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY, enricher TEXT, status INTEGER,
+            body BLOB, size INTEGER, created REAL, accessed REAL)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS response_accessed
+            ON response (accessed)""")
+        self.conn.commit()
+
+    @property
+    def conn(self):
+        # SQLite connections cannot be shared between threads.
+        if not hasattr(self.local, 'conn'):
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.text_factory = str
+            self.local.conn = conn
+        return self.local.conn
+
+    def get(self, enricher, key):
+        """Get a cached ``(status, body)``, or None."""
+        cur = self.conn.execute("""SELECT status, body, created
+            FROM response WHERE key = ?""", (key,))
+        row = cur.fetchone()
+        if row is not None:
+            status, body, created = row
+            # When offline, stale responses are better than none.
+            if self.offline or created > time() - get_ttl(enricher):
+                self.hits[enricher] += 1
+                self.conn.execute("""UPDATE response SET accessed = ?
+                    WHERE key = ?""", (time(), key))
+                self.conn.commit()
+                return status, body
+        self.misses[enricher] += 1
+        if self.offline:
+            raise CacheMiss("Not in cache (offline mode): %s" % key)
+
+    def set(self, enricher, key, status, body):
+        now = time()
+        self.conn.execute("""INSERT OR REPLACE INTO response
+            (key, enricher, status, body, size, created, accessed)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                          (key, enricher, status, sqlite3.Binary(body),
+                           len(body), now, now))
+        self.conn.commit()
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used responses until the cache is
+        below its maximum size."""
+        cur = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM response")
+        total = cur.fetchone()[0]
+        if total <= self.max_size:
+            return
+        excess = total - (self.max_size * 0.9)
+        cur = self.conn.execute("""SELECT key, size FROM response
+            ORDER BY accessed ASC""")
+        keys = []
+        for key, size in cur:
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany("DELETE FROM response WHERE key = ?", keys)
+        self.conn.commit()
+        log.info("HTTP cache: evicted %d responses.", len(keys))
+
+    def request(self, enricher, method, url, params, fetch):
+        """Return a cached response for the request, or call ``fetch``
+        and store the response it returns if it was successful."""
+        key = cache_key(method, url, params)
+        cached = self.get(enricher, key)
+        if cached is not None:
+            return make_response(url, *cached)
+        res = fetch()
+        if res.status_code == 200:
+            self.set(enricher, key, res.status_code, res.content)
+        return res
+
+    def stats(self):
+        enrichers = set(self.hits.keys()).union(self.misses.keys())
+        return {e: (self.hits[e], self.misses[e]) for e in enrichers}
+
+    def log_stats(self):
+        for enricher, (hits, misses) in sorted(self.stats().items()):
+            log.info("HTTP cache [%s]: %d hits, %d misses",
+                     enricher, hits, misses)
+
+
+def make_response(url, status, body):
+    res = Response()
+    res.status_code = status
+    res._content = bytes(body)
+    res.url = url
+    res.headers = CaseInsensitiveDict({'X-Corpint-Cache': 'hit'})
+    res.encoding = 'utf-8'
+    return res
+
+
+class CachingAdapter(HTTPAdapter):
+    """A requests transport adapter which answers from the response cache,
+    for clients such as mwclient which bring their own session."""
+
+    def __init__(self, enricher, **kwargs):
+        self.enricher = enricher
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        params = []
+        content_type = request.headers.get('Content-Type', '')
+        if request.body and 'x-www-form-urlencoded' in content_type:
+            params = parse_qsl(request.body)
+
+        def fetch():
+            return self.fetch(request, **kwargs)
+
+        cache = get_cache()
+        res = cache.request(self.enricher, request.method, request.url,
+                            params, fetch)
+        res.request = request
+        return res
+
+    def fetch(self, request, **kwargs):
+        return super(CachingAdapter, self).send(request, **kwargs)
+
+
+def get_cache():
+    with lock:
+        if not hasattr(config, 'http_cache'):
+            config.http_cache = ResponseCache(config.cache_path,
+                                              max_size=config.cache_size,
+                                              offline=config.offline)
+    return config.http_cache
+
+
+def cached_request(enricher, method, url, params, fetch):
+    """Fetch a response via the shared cache."""
+    return get_cache().request(enricher, method, url, params, fetch)
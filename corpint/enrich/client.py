@@ -0,0 +1,56 @@
+import threading
+import requests
+
+from corpint.core import config
+from corpint.enrich.cache import CachingAdapter
+from corpint.enrich.scheduler import get_scheduler
+
+lock = threading.Lock()
+SESSIONS = {}
+
+
+class EnricherSession(requests.Session):
+    """A requests session with a default timeout."""
+
+    def __init__(self, timeout=None):
+        super(EnricherSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(EnricherSession, self).request(method, url, **kwargs)
+
+
+class ScheduledAdapter(CachingAdapter):
+    """A caching adapter which sends requests that are not cached via the
+    enricher's rate limiting and retrying scheduler."""
+
+    def fetch(self, request, **kwargs):
+        send = super(ScheduledAdapter, self).fetch
+        scheduler = get_scheduler(self.enricher)
+        return scheduler.request(request.url,
+                                 lambda: send(request, **kwargs))
+
+
+def make_session(enricher):
+    session = EnricherSession(timeout=config.http_timeout)
+    session.verify = config.http_verify
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+    adapter = ScheduledAdapter(enricher,
+                               pool_connections=4,
+                               pool_maxsize=config.http_pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(enricher):
+    """Get the shared HTTP session of an enricher. Connections are pooled
+    and kept alive between requests, responses are cached and requests
+    are rate limited and retried."""
+    with lock:
+        if enricher not in SESSIONS:
+            SESSIONS[enricher] = make_session(enricher)
+    return SESSIONS[enricher]
@@ -0,0 +1,81 @@
+import json
+import logging
+from os import environ
+from dalet import clean_address
+
+from corpint.core import session, project
+from corpint.model import Address, Geocode
+from corpint.util import get_extensions
+
+log = logging.getLogger(__name__)
+
+
+class StaticGeocoder(object):
+    """A local stand-in geocoder which looks addresses up in a JSON file,
+    given as ``CORPINT_GEOCODE_FILE``. It maps each address to an object
+    with ``normalized``, ``latitude`` and ``longitude``."""
+
+    def __init__(self, path=None):
+        path = path or environ.get('CORPINT_GEOCODE_FILE')
+        self.results = {}
+        if path is not None:
+            with open(path, 'r') as fh:
+                self.results = json.load(fh)
+
+    def geocode(self, address):
+        return self.results.get(address)
+
+
+def get_geocoders():
+    from corpint.enrich.gmaps import GoogleGeocoder
+    geocoders = {
+        'gmaps': GoogleGeocoder,
+        'static': StaticGeocoder
+    }
+    geocoders.update(get_extensions('corpint.geocoders'))
+    return geocoders
+
+
+def get_geocoder(name):
+    """Create a geocoder backend. Other backends can be registered as
+    ``corpint.geocoders`` entry points; they are classes with a
+    ``geocode(address)`` method which returns a dict or None."""
+    geocoders = get_geocoders()
+    if name not in geocoders:
+        raise RuntimeError("Geocoder not found: %s" % name)
+    geocoder = geocoders[name]()
+    geocoder.name = name
+    return geocoder
+
+
+def geocode_slugs(geocoder, slugs, retry=False):
+    """Geocode one address for each slug, unless its result is cached, and
+    update all addresses with that slug."""
+    cached = Geocode.find_by_slugs(geocoder.name, slugs.keys())
+    results = []
+    for slug, address in slugs.items():
+        geocode = cached.get(slug)
+        if geocode is None or (retry and not geocode.found):
+            address = clean_address(address)
+            log.info("Geocoding: %s", address)
+            geocode = Geocode.save(geocoder.name, slug,
+                                   geocoder.geocode(address))
+            if not geocode.found:
+                log.info("No results: %s", address)
+        if geocode.found:
+            results.append(geocode)
+    Address.update_many(results)
+    session.commit()
+    return len(results)
+
+
+def geocode_addresses(geocoder, retry=False, chunk_size=500):
+    """Geocode all the distinct addresses in the project."""
+    slugs = dict(Address.find_ungeocoded().all())
+    project.log.info("Geocoding %d distinct addresses...", len(slugs))
+    slugs = list(slugs.items())
+    found = 0
+    for i in range(0, len(slugs), chunk_size):
+        found += geocode_slugs(geocoder, dict(slugs[i:i + chunk_size]),
+                               retry=retry)
+    project.log.info("Geocoded %d of %d addresses.", found, len(slugs))
@@ -1,10 +1,14 @@
+import threading
 from os import environ
 import googlemaps
 
-from corpint.core import session
 from corpint.model import Address
+from corpint.enrich.geocode import get_geocoder, geocode_slugs
+from corpint.enrich.runner import EnrichmentSkipped
 
 API_KEY = environ.get('GMAPS_APIKEY')
+lock = threading.Lock()
+GEOCODER = None
 
 
 def remove_first_section_of_address(address):
@@ -29,19 +33,35 @@ def geocode(gmaps, address):
     return results
 
 
+class GoogleGeocoder(object):
+    """Geocode addresses with the Google Maps API, using one client."""
+
+    def __init__(self):
+        self.client = googlemaps.Client(key=API_KEY)
+
+    def geocode(self, address):
+        for result in geocode(self.client, address):
+            return {
+                'normalized': result['formatted_address'],
+                'latitude': result['geometry']['location']['lat'],
+                'longitude': result['geometry']['location']['lng']
+            }
+
+
+def get_shared_geocoder():
+    global GEOCODER
+    with lock:
+        if GEOCODER is None:
+            GEOCODER = get_geocoder('gmaps')
+    return GEOCODER
+
+
 def enrich(origin, entity):
-    gmaps = googlemaps.Client(key=API_KEY)
-    for uid in entity.uids:
-        q = Address.find_by_entity(uid)
-        q = q.filter(Address.normalized == None)  # noqa
-        for address in q:
-            origin.log.info("Geocoding [%s] %s", entity.name, address.clean)
-            results = geocode(gmaps, address.clean)
-            if not len(results):
-                origin.log.info("No results: %s" % address.clean)
-            for result in results:
-                address.update(normalized=result['formatted_address'],
-                               latitude=result['geometry']['location']['lat'],
-                               longitude=result['geometry']['location']['lng'])
-                break
-        session.commit()
+    if API_KEY is None:
+        raise EnrichmentSkipped('$GMAPS_APIKEY not set.')
+    slugs = dict(Address.find_ungeocoded(entity_uids=entity.uids).all())
+    if len(slugs):
+        origin.log.info("Geocoding [%s]: %d addresses",
+                        entity.name, len(slugs))
+        geocode_slugs(get_shared_geocoder(), slugs)
+    return True
@@ -1,12 +1,12 @@
 import logging
-import requests
-from time import sleep
 from os import environ
 from urllib import quote_plus
 from itertools import count
 from pprint import pprint  # noqa
 
 from corpint.model.schema import PERSON, OTHER, ORGANIZATION, COMPANY
+from corpint.enrich.client import get_session
+from corpint.enrich.scheduler import TransientError
 
 log = logging.getLogger(__name__)
 API_KEY = environ.get('OPENCORPORATES_APIKEY')
@@ -22,13 +22,14 @@ def get_oc_api(url, params=None):
     params = params or dict()
     params['api_token'] = API_KEY
 
-    for i in count(2):
-        try:
-            res = requests.get(url, params=params, verify=False)
-            return res.json().get('results')
-        except Exception as ex:
-            log.exception(ex)
-            sleep(i ** 2)
+    res = get_session('opencorporates').get(url, params=params)
+    if res.status_code == 404:
+        log.warning("OpenCorporates API not found: %s", url)
+        return None
+    if res.status_code != 200:
+        raise TransientError("OpenCorporates API error [%s]: %s" %
+                             (res.status_code, url))
+    return res.json().get('results')
 
 
 def emit_officer(emitter, officer, company_url=None, publisher=None):
@@ -184,3 +185,4 @@ def enrich(origin, entity):
         search_officers(origin, entity)
     if entity.schema in [OTHER, ORGANIZATION, COMPANY]:
         search_companies(origin, entity)
+    return True
@@ -0,0 +1,164 @@
+import logging
+import threading
+from collections import defaultdict
+from Queue import Queue, Empty, Full
+
+from corpint.core import session
+from corpint.enrich.cache import CacheMiss
+from corpint.enrich.scheduler import TransientError
+
+log = logging.getLogger(__name__)
+STOP = object()
+ENRICHED = 'enriched'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class EnrichmentError(Exception):
+    pass
+
+
+class EnrichmentSkipped(Exception):
+    """Raised by an enricher which cannot run for an entity right now, e.g.
+    because a credential is missing. The entity is not marked as enriched,
+    so that it is tried again on the next run."""
+
+
+class Progress(object):
+    """Report finished entities in the order in which they were queued,
+    even if the workers complete them out of order."""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.done = {}
+        self.next = 0
+        self.counts = defaultdict(int)
+
+    def complete(self, seq, entity, status):
+        self.counts[status] += 1
+        self.done[seq] = (entity, status)
+        while self.next in self.done:
+            entity, status = self.done.pop(self.next)
+            self.next += 1
+            self.origin.log.info("Enriched [%d, %s]: %s", self.next, status,
+                                 entity.name)
+
+    def log_counts(self):
+        counts = ', '.join('%d %s' % (v, k) for (k, v)
+                           in sorted(self.counts.items()))
+        self.origin.log.info("Enrichment done: %s", counts or 'no entities')
+
+
+def enrich_entity(enrich_func, origin, entity, state=None):
+    """Run the enricher for an entity and return the outcome. Entities are
+    only marked as enriched if the enricher returns a true value."""
+    if state is not None and state.is_fresh(entity):
+        origin.log.debug("Unchanged since last run: %s", entity.name)
+        return UNCHANGED
+    try:
+        result = enrich_func(origin, entity)
+    except (EnrichmentSkipped, CacheMiss) as skip:
+        # In offline mode, entities with uncached responses are skipped.
+        session.rollback()
+        origin.log.warning("Skipped [%s]: %s", entity.name, skip)
+        return SKIPPED
+    except TransientError as error:
+        # An outage must not mark the remaining entities as enriched.
+        session.rollback()
+        origin.log.warning("Failed [%s]: %s", entity.name, error)
+        return FAILED
+    except Exception:
+        session.rollback()
+        raise
+    if not result:
+        return SKIPPED
+    if state is not None:
+        state.mark(entity)
+    return ENRICHED
+
+
+def worker(enrich_func, origin, state, tasks, results, stop):
+    # Each thread gets its own session from the scoped_session registry.
+    try:
+        while not stop.is_set():
+            task = tasks.get()
+            if task is STOP:
+                break
+            seq, entity = task
+            try:
+                status = enrich_entity(enrich_func, origin, entity,
+                                       state=state)
+                results.put((seq, entity, status, None))
+            except Exception as exc:
+                log.exception(exc)
+                results.put((seq, entity, None, exc))
+    finally:
+        session.remove()
+
+
+def run_enrichment(enrich_func, origin, entities, concurrency=1,
+                   state=None):
+    """Run ``enrich_func`` for each entity, using a bounded pool of
+    threads if ``concurrency`` is larger than one. If an
+    ``EnrichmentState`` is given, unchanged entities are skipped."""
+    progress = Progress(origin)
+    if concurrency <= 1:
+        for seq, entity in enumerate(entities):
+            status = enrich_entity(enrich_func, origin, entity, state=state)
+            progress.complete(seq, entity, status)
+        progress.log_counts()
+        return
+
+    tasks = Queue(maxsize=concurrency * 2)
+    results = Queue()
+    stop = threading.Event()
+    threads = []
+    for i in range(concurrency):
+        thread = threading.Thread(target=worker,
+                                  args=(enrich_func, origin, state,
+                                        tasks, results, stop))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def collect(block):
+        while True:
+            try:
+                # Wait with a timeout so that Ctrl-C is delivered.
+                seq, entity, status, exc = results.get(block, 0.5)
+            except Empty:
+                return
+            if exc is not None:
+                raise EnrichmentError("Failed on %r: %r" % (entity.name, exc))
+            progress.complete(seq, entity, status)
+            block = False
+
+    queued = 0
+    try:
+        for seq, entity in enumerate(entities):
+            while True:
+                collect(False)
+                try:
+                    tasks.put((seq, entity), True, 0.5)
+                    break
+                except Full:
+                    continue
+            queued += 1
+        while progress.next < queued:
+            collect(True)
+        progress.log_counts()
+    except (KeyboardInterrupt, EnrichmentError):
+        log.warning("Stopping enrichment, waiting for running tasks...")
+        stop.set()
+        raise
+    finally:
+        while True:
+            try:
+                tasks.get_nowait()
+            except Empty:
+                break
+        for thread in threads:
+            tasks.put(STOP)
+        for thread in threads:
+            thread.join()
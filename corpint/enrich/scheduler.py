@@ -0,0 +1,235 @@
+import os
+import random
+import logging
+import threading
+from time import time, sleep
+from urlparse import urlsplit
+from collections import defaultdict
+from email.utils import parsedate_tz, mktime_tz
+
+from corpint.core import config
+
+log = logging.getLogger(__name__)
+lock = threading.Lock()
+
+# Requests per second and host.
+DEFAULT_RATE = 5.0
+RATES = {
+    'aleph': 10.0,
+    'opencorporates': 2.0,
+    'wikidata': 2.0,
+    'wikipedia': 5.0,
+}
+RETRY_STATUS = [429, 500, 502, 503, 504]
+SCHEDULERS = {}
+
+
+class TransientError(Exception):
+    """Raised when a request still fails after all retries. Entities which
+    hit it are not marked as enriched, so they are tried again later."""
+
+
+class CircuitOpen(TransientError):
+    """Raised when a host has failed too often and is not contacted."""
+
+
+def get_rate(enricher):
+    """Request rate for an enricher, per second and host. Can be set with
+    e.g. ``CORPINT_RATE_LIMIT_OPENCORPORATES``."""
+    rate = os.environ.get('CORPINT_RATE_LIMIT_%s' % enricher.upper())
+    if rate is not None:
+        return float(rate)
+    return RATES.get(enricher, DEFAULT_RATE)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header, which is either a
+    number of seconds or a date."""
+    if value is None:
+        return
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is not None:
+            return max(0.0, mktime_tz(parsed) - time())
+
+
+class TokenBucket(object):
+    """Allow ``rate`` calls per second on average, and bursts of up to
+    ``burst`` calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time() + seconds)
+
+    def acquire(self):
+        """Block until a call is allowed; returns the time waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+            waited += wait
+
+
+class CircuitBreaker(object):
+    """Stop calling a host after ``threshold`` consecutive failures, and
+    let a single trial call through after ``cooldown`` seconds."""
+
+    def __init__(self, threshold=10, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self, host):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time() - self.opened_at < self.cooldown:
+                raise CircuitOpen("Too many failures, not calling: %s" % host)
+            # Half-open: the next failure re-opens the circuit.
+            self.opened_at = time()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """Record a failure; returns true if the circuit is now open."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time()
+                return True
+            return False
+
+
+class Scheduler(object):
+    """Schedule the requests of an enricher: rate limit them per host,
+    retry failures with jittered exponential backoff, honour
+    ``Retry-After`` and stop calling hosts which keep failing."""
+
+    def __init__(self, enricher, rate=None, retries=5, backoff=1.0,
+                 max_backoff=60.0, threshold=10, cooldown=60):
+        self.enricher = enricher
+        self.rate = rate or get_rate(enricher)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.buckets = {}
+        self.breakers = {}
+        self.metrics = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate)
+                self.breakers[host] = CircuitBreaker(self.threshold,
+                                                     self.cooldown)
+        return self.buckets[host], self.breakers[host]
+
+    def count(self, metric, value=1):
+        with self.lock:
+            self.metrics[metric] += value
+
+    def get_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def request(self, url, fetch):
+        """Call ``fetch`` for the given URL, retrying on connection errors
+        and on responses with a retryable status code. Raises a
+        ``TransientError`` once all retries have failed."""
+        host = urlsplit(url).netloc
+        bucket, breaker = self._host(host)
+        for attempt in range(self.retries + 1):
+            try:
+                breaker.check(host)
+            except CircuitOpen:
+                self.count('circuit_open')
+                raise
+            self.count('wait_seconds', bucket.acquire())
+            self.count('requests')
+            res, error, headers = None, None, {}
+            try:
+                res = fetch()
+                status, headers = res.status_code, res.headers
+            except Exception as ex:
+                error = ex
+                status = getattr(ex, 'code', None)
+                headers = getattr(ex, 'headers', None) or {}
+            if error is None and status not in RETRY_STATUS:
+                breaker.success()
+                return res
+
+            self.count('errors' if status is None else 'status_%s' % status)
+            if breaker.failure():
+                log.warning("[%s] Circuit opened for %s", self.enricher, host)
+            if attempt >= self.retries:
+                break
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            delay = self.get_delay(attempt, retry_after)
+            if status == 429:
+                # Slow down every thread calling this host.
+                bucket.pause(delay)
+            log.info("[%s] Retrying %s in %.1fs (%s)", self.enricher, host,
+                     delay, error or status)
+            self.count('retries')
+            if res is not None and res.raw is not None:
+                res.close()
+            sleep(delay)
+
+        self.count('failures')
+        if res is not None and res.raw is not None:
+            res.close()
+        raise TransientError("Request failed (%s): %s" %
+                             (error or status, url))
+
+    def log_metrics(self):
+        metrics = ', '.join('%s=%s' % (k, round(v, 1)) for (k, v)
+                            in sorted(self.metrics.items()))
+        log.info("Requests [%s]: %s", self.enricher, metrics)
+
+
+def get_scheduler(enricher):
+    """Get the shared request scheduler of an enricher."""
+    with lock:
+        if enricher not in SCHEDULERS:
+            scheduler = Scheduler(enricher,
+                                  retries=config.http_retries,
+                                  backoff=config.http_backoff,
+                                  max_backoff=config.http_max_backoff)
+            SCHEDULERS[enricher] = scheduler
+    return SCHEDULERS[enricher]
+
+
+def log_metrics():
+    for enricher, scheduler in sorted(SCHEDULERS.items()):
+        scheduler.log_metrics()
@@ -1,10 +1,19 @@
+import os
+import json
+import threading
 from urllib import quote
+from collections import defaultdict
 from SPARQLWrapper import SPARQLWrapper, JSON
 from pprint import pprint  # noqa
 
-from corpint.enrich.wikipedia import SITES
+from corpint.core import config
+from corpint.enrich.wikipedia import LANGUAGES
+from corpint.enrich.cache import cached_request, make_response
+from corpint.enrich.scheduler import get_scheduler
 
-COUNTRIES = {}  # cache object
+lock = threading.Lock()
+COUNTRIES = None  # loaded from COUNTRIES_FILE
+COUNTRIES_FILE = 'wikidata-countries.json'
 LINKS = {
     'P40': 'child',
     'P26': 'spouse',
@@ -27,43 +36,104 @@ PROPERTIES = {
     'P735': 'first_name',
 }
 
-sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
+ENDPOINT = "https://query.wikidata.org/sparql"
+LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+# ISO 3166-1 alpha-2 code, FIPS 10-4 code.
+COUNTRY_CODES = ['http://www.wikidata.org/prop/direct/P297',
+                 'http://www.wikidata.org/prop/direct/P901']
+BATCH_SIZE = 50
 
 
 def run_sparql(query):
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    for result in results["results"]["bindings"]:
+    def query_endpoint():
+        sparql = SPARQLWrapper(ENDPOINT)
+        sparql.setQuery(query)
+        sparql.setReturnFormat(JSON)
+        results = sparql.query().convert()
+        return make_response(ENDPOINT, 200, json.dumps(results))
+
+    def fetch():
+        return get_scheduler('wikidata').request(ENDPOINT, query_endpoint)
+
+    res = cached_request('wikidata', 'GET', ENDPOINT, {'query': query},
+                         fetch)
+    for result in res.json()["results"]["bindings"]:
         yield result
 
 
-def crawl_node(cid):
-    query = "SELECT ?prop ?value WHERE { <%s> ?prop ?value . }" % cid
-    for result in run_sparql(query):
-        prop = result.get('prop').get('value')
-        _, prop = prop.rsplit('/', 1)
-        yield prop, result.get('value')
+def uri_values(uris):
+    return ' '.join(['<%s>' % uri for uri in uris])
+
+
+def crawl_nodes(uris, props=None):
+    """Get the ``(prop, value)`` pairs of many nodes, with one query per
+    ``BATCH_SIZE`` nodes. ``props`` can limit the property URIs."""
+    nodes = defaultdict(list)
+    uris = sorted(set(uris))
+    for i in range(0, len(uris), BATCH_SIZE):
+        values = "VALUES ?node { %s } " % uri_values(uris[i:i + BATCH_SIZE])
+        if props is not None:
+            values += "VALUES ?prop { %s } " % uri_values(props)
+        query = "SELECT ?node ?prop ?value WHERE { %s ?node ?prop ?value . }"
+        query = query % values
+        for result in run_sparql(query):
+            prop = result.get('prop').get('value')
+            _, prop = prop.rsplit('/', 1)
+            node = result.get('node').get('value')
+            nodes[node].append((prop, result.get('value')))
+    return nodes
+
+
+def countries_path():
+    return os.path.join(config.data_path, COUNTRIES_FILE)
+
+
+def get_countries(uris):
+    """Map country item URIs to country codes. Codes are kept in a file,
+    including the countries which have none."""
+    global COUNTRIES
+    with lock:
+        if COUNTRIES is None:
+            COUNTRIES = {}
+            if os.path.exists(countries_path()):
+                with open(countries_path(), 'r') as fh:
+                    COUNTRIES = json.load(fh)
+        missing = [u for u in set(uris) if u not in COUNTRIES]
+    if len(missing):
+        nodes = crawl_nodes(missing, props=COUNTRY_CODES)
+        with lock:
+            for uri in missing:
+                codes = dict(nodes.get(uri, []))
+                COUNTRIES[uri] = codes.get('P297', {}).get('value') or \
+                    codes.get('P901', {}).get('value')
+            if not os.path.isdir(config.data_path):
+                os.makedirs(config.data_path)
+            tmp_path = countries_path() + '.tmp'
+            with open(tmp_path, 'w') as fh:
+                json.dump(COUNTRIES, fh)
+            os.rename(tmp_path, countries_path())
+    return {u: COUNTRIES.get(u) for u in uris}
+
+
+def get_labels(uris):
+    """Get the labels of many nodes, by language."""
+    labels = defaultdict(dict)
+    for uri, values in crawl_nodes(uris, props=[LABEL]).items():
+        for _, val in values:
+            labels[uri][val.get('xml:lang', 'en')] = val.get('value')
+    return labels
 
 
-def get_country(uri):
-    if uri not in COUNTRIES:
-        for key, value in crawl_node(uri):
-            if key in ['P901', 'P297']:
-                COUNTRIES[uri] = value.get('value')
-                break
-    return COUNTRIES.get(uri)
+def is_statement(value):
+    return '/entity/statement/' in value.get('value')
 
 
-def add_literal(data, value):
+def add_literal(data, value, labels):
     if value.get('type') == 'literal':
         lang = value.get('xml:lang', 'en')
         data[lang] = value.get('value')
     else:
-        for prop, val in crawl_node(value.get('value')):
-            if prop in ['rdf-schema#label']:
-                lang = val.get('xml:lang', 'en')
-                data[lang] = val.get('value')
+        data.update(labels.get(value.get('value'), {}))
     return data
 
 
@@ -75,67 +145,113 @@ def pick_literal(data):
         return label
 
 
-def crawl_entity(emitter, cid, recurse=True):
-    uid = emitter.uid(cid)
-    if emitter.entity_exists(uid):
-        return uid
-
-    data = {
-        'wikidata_id': cid,
-        'uid': uid,
-        'aliases': set()
-    }
-    for prop, value in crawl_node(cid):
-        if prop in ['P27']:
-            if '/entity/statement/' in value.get('value'):
-                for p, val in crawl_node(value.get('value')):
-                    if p == prop:
-                        value = val
-            data['country'] = get_country(value.get('value'))
-        elif prop in ['core#altLabel', 'P742']:
-            for val in add_literal({}, value).values():
-                data['aliases'].add(val)
-        elif prop in PROPERTIES.keys():
-            field = PROPERTIES.get(prop)
-            if field is not None:
-                if field not in data:
-                    data[field] = {}
-                add_literal(data[field], value)
-        elif prop in LINKS.keys():
-            if not recurse:
-                continue
-            if '/entity/statement/' in value.get('value'):
-                for p, val in crawl_node(value.get('value')):
+def resolve_statements(nodes):
+    """Replace statement nodes of countries and links with the value of
+    the statement, fetching all statements at once."""
+    statements = set()
+    for props in nodes.values():
+        for prop, value in props:
+            if (prop == 'P27' or prop in LINKS) and is_statement(value):
+                statements.add(value.get('value'))
+    statements = crawl_nodes(statements)
+    for uri, props in nodes.items():
+        resolved = []
+        for prop, value in props:
+            if (prop == 'P27' or prop in LINKS) and is_statement(value):
+                for p, val in statements.get(value.get('value'), []):
                     if p == prop:
                         value = val
-            ouid = crawl_entity(emitter, value.get('value'), recurse=False)
-            emitter.emit_link({
-                'source_uid': uid,
-                'target_uid': ouid,
-                'summary': LINKS.get(prop)
-            })
+            resolved.append((prop, value))
+        nodes[uri] = resolved
+    return nodes
+
+
+def crawl_entities(emitter, cids, recurse=True):
+    """Crawl and emit many Wikidata items with a few batched queries and
+    return their uids. Linked items are crawled in one more batch."""
+    uids = {}
+    todo = []
+    for cid in cids:
+        uids[cid] = emitter.uid(cid)
+        if not emitter.entity_exists(uids[cid]) and cid not in todo:
+            todo.append(cid)
+    if not len(todo):
+        return uids
+
+    nodes = resolve_statements(crawl_nodes(todo))
+    countries, labelled, linked = set(), set(), set()
+    for props in nodes.values():
+        for prop, value in props:
+            if prop == 'P27':
+                countries.add(value.get('value'))
+            elif prop in ['core#altLabel', 'P742'] or prop in PROPERTIES:
+                if value.get('type') != 'literal':
+                    labelled.add(value.get('value'))
+            elif prop in LINKS and recurse:
+                if value.get('type') == 'uri':
+                    linked.add(value.get('value'))
+    countries = get_countries(countries)
+    labels = get_labels(labelled)
+    linked = crawl_entities(emitter, linked, recurse=False)
 
-    for key, value in data.items():
-        if isinstance(value, dict):
-            data[key] = pick_literal(value)
+    for cid in todo:
+        uid = uids[cid]
+        data = {
+            'wikidata_id': cid,
+            'uid': uid,
+            'aliases': set()
+        }
+        for prop, value in nodes.get(cid, []):
+            if prop in ['P27']:
+                data['country'] = countries.get(value.get('value'))
+            elif prop in ['core#altLabel', 'P742']:
+                for val in add_literal({}, value, labels).values():
+                    data['aliases'].add(val)
+            elif prop in PROPERTIES.keys():
+                field = PROPERTIES.get(prop)
+                if field is not None:
+                    if field not in data:
+                        data[field] = {}
+                    add_literal(data[field], value, labels)
+            elif prop in LINKS.keys() and recurse:
+                ouid = linked.get(value.get('value'))
+                if ouid is None:
+                    continue
+                emitter.emit_link({
+                    'source_uid': uid,
+                    'target_uid': ouid,
+                    'summary': LINKS.get(prop)
+                })
 
-    emitter.log.info("Crawled [%(wikidata_id)s]: %(name)s", data)
-    emitter.emit_entity(data)
-    return uid
+        for key, value in data.items():
+            if isinstance(value, dict):
+                data[key] = pick_literal(value)
+
+        emitter.log.info("Crawled [%(wikidata_id)s]: %(name)s", data)
+        emitter.emit_entity(data)
+    return uids
+
+
+def crawl_entity(emitter, cid, recurse=True):
+    return crawl_entities(emitter, [cid], recurse=recurse).get(cid)
 
 
 def enrich(origin, entity):
-    # print entity
-    for lang in SITES.keys():
+    urls = []
+    for lang in LANGUAGES:
         name = entity.data.get('wikipedia_%s' % lang)
         if name is None:
             continue
         slug = quote(name.encode('utf-8'))
-        url = 'https://%s.wikipedia.org/wiki/%s' % (lang, slug)
-        query = "SELECT ?item WHERE { <%s> schema:about ?item . }" % url
-        for result in run_sparql(query):
-            cid = result.get('item').get('value')
-            origin.log.info("Wikidata ID [%s]: %s", cid, entity.get('name'))
-            emitter = origin.result(entity.uid, origin.uid(cid))
-            uid = crawl_entity(emitter, cid)
-            origin.emit_judgement(uid, entity.uid, True, decided=True)
+        urls.append('https://%s.wikipedia.org/wiki/%s' % (lang, slug))
+    if not len(urls):
+        return True
+    query = "SELECT DISTINCT ?item WHERE { VALUES ?page { %s } " \
+            "?page schema:about ?item . }" % uri_values(urls)
+    for result in run_sparql(query):
+        cid = result.get('item').get('value')
+        origin.log.info("Wikidata ID [%s]: %s", cid, entity.get('name'))
+        emitter = origin.result(entity.uid, origin.uid(cid))
+        uid = crawl_entity(emitter, cid)
+        origin.emit_judgement(uid, entity.uid, True, decided=True)
+    return True
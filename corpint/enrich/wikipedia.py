@@ -1,18 +1,31 @@
 # coding: utf-8
+import threading
 from hashlib import sha1
 from pprint import pprint  # noqa
 import mwclient
 
 from corpint.model.schema import PERSON, OTHER
+from corpint.enrich.client import get_session
 
 
 ORIGIN = 'wikipedia'
 SKIP_HOSTS = ['wikiquote', 'simple.wiki', 'commons.wiki', 'collections.wiki']
 DISAMBIGUATION = [u'Шаблон:Неоднозначность', 'Template:Disambiguation']
-SITES = {
-    'en': mwclient.Site('en.wikipedia.org'),
-    'ru': mwclient.Site('ru.wikipedia.org')
-}
+LANGUAGES = ['en', 'ru']
+SITES = {}
+lock = threading.Lock()
+
+
+def get_site(lang):
+    """Connect to a Wikipedia on first use, since this already makes a
+    request."""
+    if lang not in LANGUAGES:
+        return
+    with lock:
+        if lang not in SITES:
+            SITES[lang] = mwclient.Site('%s.wikipedia.org' % lang,
+                                        pool=get_session('wikipedia'))
+    return SITES[lang]
 
 
 def get_uid(page):
@@ -41,7 +54,7 @@ def page_entity(emitter, page, path=None):
             emitter.log.info("Skip [%s]: %s", page.site.host, page.page_title)
             return
 
-    if page.pagelanguage not in SITES.keys():
+    if page.pagelanguage not in LANGUAGES:
         emitter.log.info("Skip [%s]: %s", page.site.host, page.page_title)
         return
 
@@ -65,7 +78,7 @@ def page_entity(emitter, page, path=None):
 
     for lsite, lemma in page.langlinks():
         aliases.add(lemma)
-        site = SITES.get(lsite)
+        site = get_site(lsite)
         if site is not None and lsite not in path:
             opage = site.Pages[lemma]
             ouid = page_entity(emitter, opage, path=path)
@@ -89,9 +102,10 @@ def page_entity(emitter, page, path=None):
 def enrich(origin, entity):
     # Assume entries on companies in Wikipedia are pretty useless.
     if entity.schema not in [PERSON, OTHER]:
-        return
+        return True
 
-    for lang, site in SITES.items():
+    for lang in LANGUAGES:
+        site = get_site(lang)
         origin.log.info("Search [%s]: %s", lang, entity['name'])
         for name in entity.names:
             for res in site.search(name, what='nearmatch', limit=5):
@@ -99,3 +113,4 @@ def enrich(origin, entity):
                 match_uid = origin.uid(page.pagelanguage, page.name)
                 emitter = origin.result(entity.uid, match_uid)
                 page_entity(emitter, page)
+    return True
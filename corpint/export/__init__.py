@@ -1 +1,4 @@
 from corpint.export.graph import export_to_neo4j  # noqa
+from corpint.export.graph_csv import export_to_neo4j_csv  # noqa
+from corpint.export.graph_sync import sync_to_neo4j  # noqa
+from corpint.export.table import export_to_parquet  # noqa
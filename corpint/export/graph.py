@@ -1,159 +1,295 @@
-import fingerprints
-from py2neo import Graph, Node, Relationship
+from collections import OrderedDict, defaultdict
+from py2neo import Graph
 
-from corpint.core import project, config
+from corpint.core import project, config, session
 from corpint.model import Entity, Link, Mapping, Address, Document
+from corpint.model.common import fingerprint
+from corpint.model.schema import TYPES
 
+ENTITY = 'Entity'
 ADDRESS = 'Address'
 DOCUMENT = 'Document'
 NAME = 'Name'
+# The property which identifies the nodes of each label.
+KEYS = OrderedDict([
+    (ENTITY, 'uid'),
+    (NAME, 'fp'),
+    (ADDRESS, 'slug'),
+    (DOCUMENT, 'uid'),
+])
+SCHEMATA = [t or 'Other' for t in TYPES]
 
 
-def clear_leaf_nodes(graph, label):
-    graph.run("""MATCH ()-[r]->(n:%s)
-        WITH n, collect(r) as rr
-        WHERE length(rr) <= 1 AND NOT n-->()
-        FOREACH (r IN rr | DELETE r)
-        DELETE n
-    """ % label)
+def quote(name):
+    return '`%s`' % name.replace('`', '')
 
 
-def load_entities(graph):
-    """Load composite entities into the graph."""
-    tx = graph.begin()
+def clean_properties(data):
+    props = {}
+    for key, value in data.items():
+        if value is None:
+            continue
+        if isinstance(value, (set, tuple)):
+            value = list(value)
+        props[key] = value
+    return props
+
+
+class BulkLoader(object):
+    """Load nodes and relationships with parameterized ``UNWIND``
+    statements, grouped by label and type. Each chunk of rows is sent and
+    committed on its own."""
+
+    def __init__(self, graph, chunk_size=5000):
+        self.graph = graph
+        self.chunk_size = chunk_size
+        self.nodes = OrderedDict()
+        self.rels = OrderedDict()
+        self.counts = defaultdict(int)
+
+    def create_indexes(self):
+        for label, key in KEYS.items():
+            self.graph.run('CREATE INDEX ON :%s(%s)' % (quote(label), key))
+
+    def _add(self, pending, statement, name, row):
+        key = (statement, name)
+        if key not in pending:
+            pending[key] = []
+        pending[key].append(row)
+        if len(pending[key]) >= self.chunk_size:
+            self._send(pending, key)
+
+    def _send(self, pending, key):
+        if pending is self.rels:
+            # Relationships can only be matched to nodes already loaded.
+            for node_key in list(self.nodes.keys()):
+                self._send(self.nodes, node_key)
+        rows = pending.pop(key, [])
+        if not len(rows):
+            return
+        statement, name = key
+        self.graph.run(statement, rows=rows)
+        self.counts[name] += len(rows)
+        project.log.info("Loaded %s: %d", name, self.counts[name])
+
+    def create_node(self, labels, data):
+        cypher = ':'.join([quote(label) for label in labels])
+        statement = 'UNWIND $rows AS row CREATE (n:%s) SET n = row' % cypher
+        self._add(self.nodes, statement, ':'.join(labels),
+                  clean_properties(data))
+
+    def create_rel(self, type_, source, target, data=None):
+        """Create a relationship between two nodes, each given as a tuple
+        of their label and key."""
+        (source_label, source), (target_label, target) = source, target
+        statement = 'UNWIND $rows AS row ' \
+                    'MATCH (s:%s {%s: row.source}) ' \
+                    'MATCH (t:%s {%s: row.target}) ' \
+                    'CREATE (s)-[r:%s]->(t) SET r = row.props'
+        statement = statement % (quote(source_label), KEYS[source_label],
+                                 quote(target_label), KEYS[target_label],
+                                 quote(type_))
+        row = {
+            'source': source,
+            'target': target,
+            'props': clean_properties(data or {})
+        }
+        self._add(self.rels, statement, type_, row)
+
+    def update_node(self, labels, data):
+        """Replace the properties, and the schema label, of a node."""
+        label = labels[0]
+        key = KEYS[label]
+        statement = 'UNWIND $rows AS row MATCH (n:%s {%s: row.%s}) ' % \
+            (quote(label), key, key)
+        if label == ENTITY:
+            statement += 'REMOVE n:%s SET n:%s ' % (
+                ':'.join([quote(s) for s in SCHEMATA]),
+                ':'.join([quote(name) for name in labels[1:]]))
+        statement += 'SET n = row'
+        self._add(self.nodes, statement, 'update %s' % ':'.join(labels),
+                  clean_properties(data))
+
+    def delete_node(self, label, key):
+        statement = 'UNWIND $rows AS row MATCH (n:%s {%s: row}) ' \
+                    'DETACH DELETE n' % (quote(label), KEYS[label])
+        self._add(self.nodes, statement, 'delete %s' % label, key)
+
+    def delete_rel(self, source, key):
+        """Delete a relationship from an entity, by its ``_key``; or those
+        without a key if ``key`` is None."""
+        statement = 'UNWIND $rows AS row ' \
+                    'MATCH (s:%s {%s: row.source})-[r]->() ' % \
+                    (quote(ENTITY), KEYS[ENTITY])
+        if key is None:
+            statement += 'WHERE r._key IS NULL DELETE r'
+        else:
+            statement += 'WHERE r._key = row.key DELETE r'
+        self._add(self.rels, statement, 'delete relationships',
+                  {'source': source, 'key': key})
+
+    def flush(self):
+        for key in list(self.nodes.keys()):
+            self._send(self.nodes, key)
+        for key in list(self.rels.keys()):
+            self._send(self.rels, key)
+
+
+def clear_graph(graph, chunk_size=5000):
+    """Delete all nodes, a chunk at a time."""
+    while True:
+        deleted = graph.run('MATCH (n) WITH n LIMIT %d DETACH DELETE n '
+                            'RETURN count(n)' % chunk_size).evaluate()
+        if not deleted:
+            break
+
+
+def load_entities(loader):
+    """Load composite entities into the graph, and return a mapping of
+    the UIDs of their parts to their canonical UID. Names are only loaded
+    if they are shared by more than one alias."""
     entities = {}
-    try:
-        for entity in Entity.iter_composite():
-            label = entity.schema or 'Other'
-            data = dict(entity.data)
-            data.pop('aliases', None)
-            node = Node(label, origin=entity.origin, **data)
-            project.log.info("Node [%s]: %s", label, entity.name)
-            tx.create(node)
-            for uid in entity.uids:
-                entities[uid] = node
-
-            for name in entity.names:
-                fp = fingerprints.generate(name)
-                name_node = Node(NAME, name=name, fp=fp)
-                tx.merge(name_node, NAME, 'fp')
-
-                rel = Relationship(node, 'ALIAS', name_node)
-                tx.create(rel)
-
-        clear_leaf_nodes(tx, NAME)
-        tx.commit()
-        return entities
-    except Exception:
-        tx.rollback()
-        raise
-
-
-def load_links(graph, entities):
+    names = {}
+    aliases = []
+    degrees = defaultdict(int)
+    for entity in Entity.iter_composite(rows=True):
+        label = entity.schema or 'Other'
+        data = dict(entity.data)
+        data.pop('aliases', None)
+        data['uid'] = entity.uid
+        data['origin'] = entity.origin
+        loader.create_node([ENTITY, label], data)
+        project.log.debug("Node [%s]: %s", label, entity.name)
+        for uid in entity.uids:
+            entities[uid] = entity.uid
+
+        for name in entity.names:
+            fp = fingerprint(name)
+            if fp is None:
+                continue
+            names.setdefault(fp, name)
+            aliases.append((entity.uid, fp))
+            degrees[fp] += 1
+
+    for fp, name in names.items():
+        if degrees[fp] > 1:
+            loader.create_node([NAME], {'name': name, 'fp': fp})
+    for uid, fp in aliases:
+        if degrees[fp] > 1:
+            loader.create_rel('ALIAS', (ENTITY, uid), (NAME, fp))
+    loader.flush()
+    return entities
+
+
+def load_links(loader, entities):
     """Load explicit links into the graph."""
-    tx = graph.begin()
     project.log.info("Loading %s links...", Link.find().count())
-    try:
-        for link in Link.find():
-            source = entities.get(link.source_canonical_uid)
-            target = entities.get(link.target_canonical_uid)
-            if source is None or target is None:
-                continue
-            label = link.schema or 'LINK'
-            rel = Relationship(source, label, target, **link.data)
-            tx.create(rel)
-        tx.commit()
-    except Exception:
-        tx.rollback()
-        raise
+    for link in Link.find().yield_per(10000):
+        source = entities.get(link.source_canonical_uid)
+        target = entities.get(link.target_canonical_uid)
+        if source is None or target is None:
+            continue
+        label = link.schema or 'LINK'
+        loader.create_rel(label, (ENTITY, source), (ENTITY, target),
+                          link.data)
+    loader.flush()
 
 
-def load_mappings(graph, entities, decided):
+def load_mappings(loader, entities, decided):
     """Load mappings which are decided but unsure, or undecided."""
-    tx = graph.begin()
     q = Mapping.find_by_decision(decided)
     if decided:
         q = q.filter(Mapping.judgement == None)  # noqa
     project.log.info("Loading %s mappings...", q.count())
-    try:
-        for mapping in q:
-            left = entities.get(mapping.left_uid)
-            right = entities.get(mapping.right_uid)
-            if left is None or right is None:
-                continue
-            rel = Relationship(left, 'SIMILAR', right,
-                               score=mapping.score)
-            tx.create(rel)
-        tx.commit()
-    except Exception:
-        tx.rollback()
-        raise
-
-
-def load_addresses(graph, entities):
-    """Load addresses, geocoded or otherwise."""
-    tx = graph.begin()
+    for mapping in q.yield_per(10000):
+        left = entities.get(mapping.left_uid)
+        right = entities.get(mapping.right_uid)
+        if left is None or right is None:
+            continue
+        loader.create_rel('SIMILAR', (ENTITY, left), (ENTITY, right),
+                          {'score': mapping.score})
+    loader.flush()
+
+
+def load_addresses(loader, entities):
+    """Load addresses, geocoded or otherwise, which are shared by more
+    than one entity."""
     project.log.info("Loading %s addresses...", Address.find().count())
-    addresses = {}
-    try:
-        for address in Address.find():
-            entity = entities.get(address.entity_uid)
-            if entity is None:
-                continue
-            slug = address.display_slug
-            if slug is None:
-                continue
-            if slug not in addresses:
-                node = Node(ADDRESS, name=address.display_label, slug=slug)
-                tx.create(node)
-                addresses[slug] = node
-            rel = Relationship(entity, 'LOCATED_AT', addresses[slug])
-            tx.create(rel)
-        clear_leaf_nodes(tx, ADDRESS)
-        tx.commit()
-    except Exception:
-        tx.rollback()
-        raise
-
-
-def load_documents(graph, entities):
+    q = session.query(Address.entity_uid, Address.address,
+                      Address.normalized)
+    q = q.filter(Address.project == project.name)
+    degrees = defaultdict(int)
+    for (entity_uid, address, normalized) in q.yield_per(10000):
+        if entity_uid in entities:
+            label = Address.make_display_label(address, normalized)
+            degrees[Address.make_display_slug(label)] += 1
+
+    addresses = set()
+    for address in Address.find().yield_per(10000):
+        entity = entities.get(address.entity_uid)
+        if entity is None:
+            continue
+        slug = address.display_slug
+        if slug is None or degrees[slug] < 2:
+            continue
+        if slug not in addresses:
+            loader.create_node([ADDRESS], {
+                'name': address.display_label,
+                'slug': slug
+            })
+            addresses.add(slug)
+        loader.create_rel('LOCATED_AT', (ENTITY, entity), (ADDRESS, slug))
+    loader.flush()
+
+
+def load_documents(loader, entities):
     """Load documents that mention multiple entities."""
-    tx = graph.begin()
     project.log.info("Loading %s documents...", Document.find().count())
-    documents = {}
-    try:
-        for document in Document.find():
-            entity = entities.get(document.entity_uid)
-            if entity is None:
-                continue
-            if document.uid not in documents:
-                node = Node(DOCUMENT,
-                            name=document.title,
-                            url=document.url,
-                            uid=document.uid)
-                tx.create(node)
-                documents[document.uid] = node
-            rel = Relationship(entity, 'MENTIONS', documents[document.uid])
-            tx.create(rel)
-        clear_leaf_nodes(tx, DOCUMENT)
-        tx.commit()
-    except Exception:
-        tx.rollback()
-        raise
-
-
-def export_to_neo4j(decided):
+    q = session.query(Document.uid, Document.entity_uid)
+    q = q.filter(Document.project == project.name)
+    degrees = defaultdict(int)
+    for (uid, entity_uid) in q.yield_per(10000):
+        if entity_uid in entities:
+            degrees[uid] += 1
+
+    documents = set()
+    for document in Document.find().yield_per(10000):
+        entity = entities.get(document.entity_uid)
+        if entity is None or degrees[document.uid] < 2:
+            continue
+        if document.uid not in documents:
+            loader.create_node([DOCUMENT], {
+                'name': document.title,
+                'url': document.url,
+                'uid': document.uid
+            })
+            documents.add(document.uid)
+        loader.create_rel('MENTIONS', (ENTITY, entity),
+                          (DOCUMENT, document.uid))
+    loader.flush()
+
+
+def load_graph(loader, decided):
+    """Send the composite graph to a loader, which can be a ``BulkLoader``
+    or a ``CSVLoader``."""
+    Mapping.canonicalize()
+    session.commit()
+    entities = load_entities(loader)
+    load_links(loader, entities)
+    load_mappings(loader, entities, decided)
+    load_addresses(loader, entities)
+    load_documents(loader, entities)
+    loader.flush()
+
+
+def export_to_neo4j(decided, chunk_size=5000):
     if config.neo4j_uri is None:
         project.log.error("No $NEO4J_URI set, cannot load graph.")
         return
 
     project.log.info("Loading graph to Neo4J: %s", config.neo4j_uri)
     graph = Graph(config.neo4j_uri)
-    graph.run('MATCH (n) DETACH DELETE n')
-
-    Mapping.canonicalize()
-    entities = load_entities(graph)
-    load_links(graph, entities)
-    load_mappings(graph, entities, decided)
-    load_addresses(graph, entities)
-    load_documents(graph, entities)
+    clear_graph(graph, chunk_size=chunk_size)
+    loader = BulkLoader(graph, chunk_size=chunk_size)
+    loader.create_indexes()
+    load_graph(loader, decided)
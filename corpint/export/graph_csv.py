@@ -0,0 +1,129 @@
+import os
+import json
+from tempfile import TemporaryFile
+from collections import OrderedDict
+from unicodecsv import writer as csv_writer
+
+from corpint.core import project
+from corpint.export.graph import KEYS, clean_properties, load_graph
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, long)):
+        return 'long'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, list):
+        return 'string[]'
+    return 'string'
+
+
+def merge_types(left, right):
+    if left is None or left == right:
+        return right
+    if set([left, right]) == set(['long', 'float']):
+        return 'float'
+    if 'string[]' in (left, right):
+        return 'string[]'
+    return 'string'
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return ';'.join([unicode(v) for v in value])
+    return unicode(value)
+
+
+class CSVTable(object):
+    """A CSV file in the ``neo4j-admin import`` format. The property
+    columns are only known once all rows are written, so rows are spooled
+    to a temporary file until the table is closed."""
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.types = OrderedDict()
+        self.spool = TemporaryFile()
+        self.count = 0
+
+    def write(self, values, props):
+        for key, value in props.items():
+            self.types[key] = merge_types(self.types.get(key),
+                                          value_type(value))
+        self.spool.write(json.dumps([values, props]) + '\n')
+        self.count += 1
+
+    def close(self):
+        header = list(self.header)
+        for key, type_ in self.types.items():
+            header.append('%s:%s' % (key, type_))
+        self.spool.seek(0)
+        with open(self.path, 'wb') as fh:
+            writer = csv_writer(fh, encoding='utf-8')
+            writer.writerow(header)
+            for line in self.spool:
+                values, props = json.loads(line)
+                row = [format_value(v) for v in values]
+                for key in self.types.keys():
+                    row.append(format_value(props.get(key)))
+                writer.writerow(row)
+        self.spool.close()
+        project.log.info("Wrote %d rows: %s", self.count, self.path)
+
+
+class CSVLoader(object):
+    """Write the graph as node and relationship CSV files for
+    ``neo4j-admin import``, with one ID space per node label. It has the
+    same interface as the ``BulkLoader``."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.tables = OrderedDict()
+
+    def table(self, name, header):
+        if name not in self.tables:
+            path = os.path.join(self.directory, '%s.csv' % name)
+            self.tables[name] = CSVTable(path, header)
+        return self.tables[name]
+
+    def create_node(self, labels, data):
+        label = labels[0]
+        props = clean_properties(data)
+        key = props.pop(KEYS[label])
+        header = ['%s:ID(%s)' % (KEYS[label], label), ':LABEL']
+        table = self.table('nodes_%s' % label, header)
+        table.write([key, ';'.join(labels)], props)
+
+    def create_rel(self, type_, source, target, data=None):
+        (source_label, source), (target_label, target) = source, target
+        header = [':START_ID(%s)' % source_label,
+                  ':END_ID(%s)' % target_label, ':TYPE']
+        name = 'rels_%s_%s_%s' % (type_, source_label, target_label)
+        table = self.table(name, header)
+        table.write([source, target, type_], clean_properties(data or {}))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+
+
+def export_to_neo4j_csv(directory, decided):
+    loader = CSVLoader(directory)
+    load_graph(loader, decided)
+    loader.close()
+    args = ['neo4j-admin import', '--ignore-empty-strings=true']
+    for name, table in loader.tables.items():
+        kind = 'nodes' if name.startswith('nodes_') else 'relationships'
+        args.append('--%s %s' % (kind, table.path))
+    project.log.info("Import with: %s", ' '.join(args))
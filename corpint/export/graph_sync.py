@@ -0,0 +1,110 @@
+import json
+from hashlib import sha1
+from collections import defaultdict
+from py2neo import Graph
+
+from corpint.core import project, config
+from corpint.export.graph import KEYS, ENTITY, BulkLoader
+from corpint.export.graph import quote, clean_properties, load_graph
+
+MISSING = object()
+
+
+def node_hash(labels, props):
+    data = json.dumps([labels, props], sort_keys=True)
+    return unicode(sha1(data.encode('utf-8')).hexdigest())
+
+
+def rel_key(type_, source, target, props):
+    data = json.dumps([type_, source, target, props], sort_keys=True)
+    return unicode(sha1(data.encode('utf-8')).hexdigest())
+
+
+class SyncLoader(object):
+    """Update the graph in Neo4J to match the composite graph, writing
+    only what has changed. Nodes are stored with a hash of their labels
+    and properties (``_hash``), relationships with a key made from their
+    type, endpoints and properties (``_key``)."""
+
+    def __init__(self, graph, chunk_size=5000):
+        self.graph = graph
+        self.writer = BulkLoader(graph, chunk_size=chunk_size)
+        self.nodes = {}
+        self.rels = {}
+        self.occurrences = defaultdict(int)
+        self.stats = defaultdict(int)
+
+    def load_state(self):
+        """Get the key and hash of every node, and the key and source of
+        every relationship, in the graph."""
+        for label, key in KEYS.items():
+            q = 'MATCH (n:%s) RETURN n.%s, n._hash' % (quote(label), key)
+            self.nodes[label] = {k: h for (k, h) in self.graph.run(q)}
+        q = 'MATCH (s:%s)-[r]->() RETURN s.%s, r._key' % \
+            (quote(ENTITY), KEYS[ENTITY])
+        unkeyed = set()
+        for (source, key) in self.graph.run(q):
+            if key is None:
+                unkeyed.add(source)
+            else:
+                self.rels[key] = source
+        # Relationships loaded without a key are replaced.
+        for source in unkeyed:
+            self.writer.delete_rel(source, None)
+        self.stats['deleted relationships'] += len(unkeyed)
+        project.log.info("Graph state: %d nodes, %d relationships",
+                         sum([len(n) for n in self.nodes.values()]),
+                         len(self.rels))
+
+    def create_node(self, labels, data):
+        label = labels[0]
+        props = clean_properties(data)
+        props['_hash'] = node_hash(labels, props)
+        existing = self.nodes[label].pop(props[KEYS[label]], MISSING)
+        if existing is MISSING:
+            self.writer.create_node(labels, props)
+            self.stats['created nodes'] += 1
+        elif existing != props['_hash']:
+            self.writer.update_node(labels, props)
+            self.stats['updated nodes'] += 1
+
+    def create_rel(self, type_, source, target, data=None):
+        props = clean_properties(data or {})
+        key = rel_key(type_, source, target, props)
+        # Identical relationships are told apart by their position.
+        self.occurrences[key] += 1
+        key = '%s:%d' % (key, self.occurrences[key])
+        if self.rels.pop(key, MISSING) is MISSING:
+            props['_key'] = key
+            self.writer.create_rel(type_, source, target, props)
+            self.stats['created relationships'] += 1
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        """Delete the nodes and relationships which were not seen."""
+        for key, source in self.rels.items():
+            self.writer.delete_rel(source, key)
+            self.stats['deleted relationships'] += 1
+        for label, nodes in self.nodes.items():
+            for key in nodes.keys():
+                self.writer.delete_node(label, key)
+                self.stats['deleted nodes'] += 1
+        self.writer.flush()
+        for name, count in sorted(self.stats.items()):
+            project.log.info("Sync: %d %s", count, name)
+
+
+def sync_to_neo4j(decided, chunk_size=5000):
+    if config.neo4j_uri is None:
+        project.log.error("No $NEO4J_URI set, cannot load graph.")
+        return
+
+    project.log.info("Syncing graph to Neo4J: %s", config.neo4j_uri)
+    graph = Graph(config.neo4j_uri)
+    loader = SyncLoader(graph, chunk_size=chunk_size)
+    loader.writer.create_indexes()
+    loader.load_state()
+    load_graph(loader, decided)
+    loader.close()
@@ -1,6 +1,236 @@
-from corpint.core import project, config
+import os
+import json
+from glob import glob
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from corpint.core import project, session
 from corpint.model import Entity, Link, Mapping, Address, Document
 
+# Columns with few distinct values are dictionary-encoded in the files.
+DICTIONARY = ['origin', 'schema', 'country']
+
+STRINGS = pa.list_(pa.string())
+ENTITIES = pa.schema([
+    pa.field('uid', pa.string()),
+    pa.field('name', pa.string()),
+    pa.field('schema', pa.string()),
+    pa.field('country', pa.string()),
+    pa.field('origin', pa.string()),
+    pa.field('origins', STRINGS),
+    pa.field('tasked', pa.bool_()),
+    pa.field('uids', STRINGS),
+    pa.field('aliases', STRINGS),
+    pa.field('data', pa.string()),
+])
+LINKS = pa.schema([
+    pa.field('source_uid', pa.string()),
+    pa.field('source_canonical_uid', pa.string()),
+    pa.field('target_uid', pa.string()),
+    pa.field('target_canonical_uid', pa.string()),
+    pa.field('origin', pa.string()),
+    pa.field('schema', pa.string()),
+    pa.field('data', pa.string()),
+])
+MAPPINGS = pa.schema([
+    pa.field('left_uid', pa.string()),
+    pa.field('left_canonical_uid', pa.string()),
+    pa.field('right_uid', pa.string()),
+    pa.field('right_canonical_uid', pa.string()),
+    pa.field('judgement', pa.bool_()),
+    pa.field('decided', pa.bool_()),
+    pa.field('generated', pa.bool_()),
+    pa.field('score', pa.float64()),
+])
+ADDRESSES = pa.schema([
+    pa.field('entity_uid', pa.string()),
+    pa.field('canonical_uid', pa.string()),
+    pa.field('origin', pa.string()),
+    pa.field('address', pa.string()),
+    pa.field('slug', pa.string()),
+    pa.field('normalized', pa.string()),
+    pa.field('latitude', pa.float64()),
+    pa.field('longitude', pa.float64()),
+])
+DOCUMENTS = pa.schema([
+    pa.field('uid', pa.string()),
+    pa.field('entity_uid', pa.string()),
+    pa.field('canonical_uid', pa.string()),
+    pa.field('origin', pa.string()),
+    pa.field('title', pa.string()),
+    pa.field('url', pa.string()),
+    pa.field('publisher', pa.string()),
+])
+
+
+class ParquetTable(object):
+    """A table written as a directory of Parquet part files. Rows are
+    buffered and written as one row group per ``chunk_size`` rows, and a
+    new part is started every ``part_size`` rows."""
+
+    def __init__(self, directory, name, schema, chunk_size=50000,
+                 part_size=1000000):
+        self.path = os.path.join(directory, name)
+        self.name = name
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.part_size = part_size
+        self.columns = {field: [] for field in schema.names}
+        self.writer = None
+        self.parts = 0
+        self.part_count = 0
+        self.count = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Parts left over from a previous export would be read as well.
+        for part in glob(os.path.join(self.path, 'part-*.parquet')):
+            os.unlink(part)
+
+    def write(self, row):
+        for field, values in self.columns.items():
+            values.append(row.get(field))
+        if len(values) >= self.chunk_size:
+            self.flush()
+
+    def _open_part(self):
+        if self.writer is not None:
+            self.writer.close()
+        path = os.path.join(self.path, 'part-%05d.parquet' % self.parts)
+        use_dictionary = [f for f in DICTIONARY if f in self.schema.names]
+        self.writer = pq.ParquetWriter(path, self.schema,
+                                       use_dictionary=use_dictionary,
+                                       compression='snappy')
+        self.parts += 1
+        self.part_count = 0
+
+    def flush(self):
+        size = len(self.columns[self.schema.names[0]])
+        if size == 0:
+            return
+        if self.writer is None or self.part_count >= self.part_size:
+            self._open_part()
+        arrays = []
+        for i in range(len(self.schema)):
+            field = self.schema[i]
+            arrays.append(pa.array(self.columns[field.name],
+                                   type=field.type))
+            self.columns[field.name] = []
+        table = pa.Table.from_arrays(arrays, names=self.schema.names)
+        self.writer.write_table(table)
+        self.part_count += size
+        self.count += size
+
+    def close(self):
+        self.flush()
+        if self.writer is None:
+            # Write an empty part so that the table can still be read.
+            self._open_part()
+        self.writer.close()
+        project.log.info("Wrote %d %s in %d parts: %s", self.count,
+                         self.name, self.parts, self.path)
+
+
+def export_entities(directory, chunk_size):
+    """Write composite entities, and return a mapping of the UIDs of
+    their parts to their canonical UID."""
+    table = ParquetTable(directory, 'entities', ENTITIES,
+                         chunk_size=chunk_size)
+    entities = {}
+    for entity in Entity.iter_composite(rows=True):
+        data = dict(entity.data)
+        data.pop('name', None)
+        data.pop('aliases', None)
+        table.write({
+            'uid': entity.uid,
+            'name': entity.name,
+            'schema': entity.schema,
+            'country': entity.country,
+            'origin': entity.origin,
+            'origins': sorted(entity.origins),
+            'tasked': bool(entity.tasked),
+            'uids': sorted(entity.uids),
+            'aliases': sorted([n for n in entity.names if n is not None]),
+            'data': json.dumps(data, sort_keys=True)
+        })
+        for uid in entity.uids:
+            entities[uid] = entity.uid
+    table.close()
+    return entities
+
+
+def export_links(directory, entities, chunk_size):
+    table = ParquetTable(directory, 'links', LINKS, chunk_size=chunk_size)
+    for link in Link.find().yield_per(10000):
+        table.write({
+            'source_uid': link.source_uid,
+            'source_canonical_uid': entities.get(link.source_uid),
+            'target_uid': link.target_uid,
+            'target_canonical_uid': entities.get(link.target_uid),
+            'origin': link.origin,
+            'schema': link.schema,
+            'data': json.dumps(link.data or {}, sort_keys=True)
+        })
+    table.close()
+
+
+def export_mappings(directory, entities, chunk_size):
+    table = ParquetTable(directory, 'mappings', MAPPINGS,
+                         chunk_size=chunk_size)
+    q = session.query(Mapping).filter(Mapping.project == project.name)
+    for mapping in q.yield_per(10000):
+        table.write({
+            'left_uid': mapping.left_uid,
+            'left_canonical_uid': entities.get(mapping.left_uid),
+            'right_uid': mapping.right_uid,
+            'right_canonical_uid': entities.get(mapping.right_uid),
+            'judgement': mapping.judgement,
+            'decided': bool(mapping.decided),
+            'generated': bool(mapping.generated),
+            'score': mapping.score
+        })
+    table.close()
+
+
+def export_addresses(directory, entities, chunk_size):
+    table = ParquetTable(directory, 'addresses', ADDRESSES,
+                         chunk_size=chunk_size)
+    for address in Address.find().yield_per(10000):
+        table.write({
+            'entity_uid': address.entity_uid,
+            'canonical_uid': entities.get(address.entity_uid),
+            'origin': address.origin,
+            'address': address.address,
+            'slug': address.slug,
+            'normalized': address.normalized,
+            'latitude': address.latitude,
+            'longitude': address.longitude
+        })
+    table.close()
+
+
+def export_documents(directory, entities, chunk_size):
+    table = ParquetTable(directory, 'documents', DOCUMENTS,
+                         chunk_size=chunk_size)
+    for document in Document.find().yield_per(10000):
+        table.write({
+            'uid': document.uid,
+            'entity_uid': document.entity_uid,
+            'canonical_uid': entities.get(document.entity_uid),
+            'origin': document.origin,
+            'title': document.title,
+            'url': document.url,
+            'publisher': document.publisher
+        })
+    table.close()
+
 
-def export_to_csv(filename):
-    pass
+def export_to_parquet(directory, chunk_size=50000):
+    """Write the project as a directory of Parquet tables, one
+    sub-directory per table, for analysis with pandas, Spark or DuckDB."""
+    Mapping.canonicalize()
+    session.commit()
+    entities = export_entities(directory, chunk_size)
+    export_links(directory, entities, chunk_size)
+    export_mappings(directory, entities, chunk_size)
+    export_addresses(directory, entities, chunk_size)
+    export_documents(directory, entities, chunk_size)
@@ -6,17 +6,27 @@ from corpint.model.entity import Entity  # noqa
 from corpint.model.link import Link  # noqa
 from corpint.model.mapping import Mapping  # noqa
 from corpint.model.address import Address  # noqa
+from corpint.model.geocode import Geocode  # noqa
 from corpint.model.document import Document  # noqa
+from corpint.model.cluster import Cluster  # noqa
+from corpint.model.state import State  # noqa
+from corpint.model.enrichment import Enrichment, EnrichmentState  # noqa
 from corpint.model.common import Base
+from corpint.model.upgrade import upgrade_database
 
 log = logging.getLogger(__name__)
 
 
-def create_session(database_uri):
-    """Connect to the database and create the tables."""
+def create_session(database_uri, pool_size=None):
+    """Connect to the database and create the tables. Sessions are
+    thread-local, so each worker thread gets its own."""
     if database_uri is None:
         raise RuntimeError("No $DATABASE_URI is set, aborting.")
-    engine = create_engine(database_uri)
+    options = {}
+    if pool_size is not None and not database_uri.startswith('sqlite'):
+        options['pool_size'] = pool_size
+    engine = create_engine(database_uri, **options)
     Base.metadata.create_all(engine)
+    upgrade_database(engine)
     session_factory = sessionmaker(bind=engine)
     return scoped_session(session_factory)
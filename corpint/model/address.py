@@ -1,6 +1,6 @@
 from normality import stringify, slugify
 from dalet import clean_address
-from sqlalchemy import Column, Unicode, Integer, Float
+from sqlalchemy import Column, Unicode, Integer, Float, func, bindparam
 
 from corpint.core import session, project
 from corpint.model.common import Base, SchemaObject, UID_LENGTH
@@ -27,12 +27,19 @@ class Address(SchemaObject, Base):
 
     @property
     def display_label(self):
-        address = self.normalized or self.address
-        return clean_address(address)
+        return self.make_display_label(self.address, self.normalized)
 
     @property
     def display_slug(self):
-        return slugify(self.display_label, sep=' ')
+        return self.make_display_slug(self.display_label)
+
+    @classmethod
+    def make_display_label(cls, address, normalized=None):
+        return clean_address(normalized or address)
+
+    @classmethod
+    def make_display_slug(cls, label):
+        return slugify(label, sep=' ')
 
     def delete(self):
         session.delete(self)
@@ -65,6 +72,61 @@ class Address(SchemaObject, Base):
         session.add(obj)
         return obj
 
+    @classmethod
+    def save_many(cls, addresses, origin):
+        """Insert a list of ``(entity_uid, address)`` pairs in bulk. This
+        does not check for existing rows, so clear them out first."""
+        rows = []
+        for entity_uid, address in addresses:
+            if entity_uid is None:
+                raise ValueError("No UID on address: %r" % address)
+            address = stringify(address)
+            if address is None:
+                continue
+            rows.append({
+                'project': project.name,
+                'origin': origin,
+                'entity_uid': entity_uid,
+                'address': address,
+                'slug': slugify(clean_address(address), sep=' ')
+            })
+        if len(rows):
+            session.execute(cls.__table__.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def update_many(cls, geocodes):
+        """Set the normalized form and location of all addresses with the
+        slugs of the given ``Geocode`` results."""
+        rows = []
+        for geocode in geocodes:
+            rows.append({
+                'b_slug': geocode.slug,
+                'normalized': geocode.normalized,
+                'latitude': geocode.latitude,
+                'longitude': geocode.longitude,
+            })
+        if not len(rows):
+            return
+        table = cls.__table__
+        stmt = table.update()
+        stmt = stmt.where(table.c.project == project.name)
+        stmt = stmt.where(table.c.slug == bindparam('b_slug'))
+        session.execute(stmt, rows)
+
+    @classmethod
+    def find_ungeocoded(cls, entity_uids=None):
+        """Get each slug of the addresses which have not been normalized,
+        with one of their addresses."""
+        q = session.query(cls.slug, func.min(cls.address))
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.normalized == None)  # noqa
+        q = q.filter(cls.slug != None)  # noqa
+        if entity_uids is not None:
+            q = q.filter(cls.entity_uid.in_(entity_uids))
+        q = q.group_by(cls.slug)
+        return q
+
     @classmethod
     def get(cls, entity_uid, address, origin=None):
         q = cls.find()
@@ -88,5 +150,10 @@ class Address(SchemaObject, Base):
     def delete_by_entity(cls, entity_uid):
         cls.find_by_entity(entity_uid).delete()
 
+    @classmethod
+    def delete_by_entities(cls, entity_uids):
+        q = cls.find().filter(cls.entity_uid.in_(entity_uids))
+        q.delete(synchronize_session=False)
+
     def __repr__(self):
         return '<Address(%r, %r)>' % (self.entity_uid, self.clean)
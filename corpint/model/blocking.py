@@ -0,0 +1,139 @@
+import re
+import logging
+from itertools import combinations
+from collections import OrderedDict, defaultdict
+from normality import stringify
+
+from corpint.util import get_extensions
+
+log = logging.getLogger(__name__)
+
+SOUNDEX = dict(zip('bfpvcgjkqsxzdtlmnr', '111122222222334556'))
+REGNR_CLEAN = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def soundex(token):
+    """Four-character American Soundex code of a (latinized) token."""
+    token = token.lower()
+    if not len(token):
+        return
+    code, last = token[0], SOUNDEX.get(token[0])
+    for char in token[1:]:
+        digit = SOUNDEX.get(char)
+        if digit is not None and digit != last:
+            code += digit
+        if char not in 'hw':
+            last = digit
+    return (code + '000')[:4]
+
+
+def name_tokens(entity):
+    for fp in entity.fingerprints:
+        for token in fp.split():
+            if len(token) > 2:
+                yield token
+
+
+def block_tokens(entity):
+    """Any fingerprint token of three letters or more."""
+    return name_tokens(entity)
+
+
+def block_sorted_tokens(entity):
+    """The full fingerprint with its tokens in sorted order."""
+    for fp in entity.fingerprints:
+        yield ' '.join(sorted(fp.split()))
+
+
+def block_phonetic(entity):
+    """The set of phonetic codes for the tokens in a fingerprint."""
+    for fp in entity.fingerprints:
+        codes = set([soundex(t) for t in fp.split()])
+        codes.discard(None)
+        if len(codes):
+            yield ' '.join(sorted(codes))
+
+
+def block_country(entity):
+    """Fingerprint tokens qualified by the entity country."""
+    if entity.country is None:
+        return
+    for token in name_tokens(entity):
+        yield '%s:%s' % (entity.country, token)
+
+
+def block_registration_number(entity):
+    regnr = stringify(entity.data.get('registration_number'))
+    if regnr is None:
+        return
+    regnr = REGNR_CLEAN.sub('', regnr).upper()
+    if len(regnr):
+        yield regnr
+
+
+BLOCKERS = OrderedDict([
+    ('tokens', block_tokens),
+    ('sorted', block_sorted_tokens),
+    ('phonetic', block_phonetic),
+    ('country', block_country),
+    ('regnr', block_registration_number),
+])
+
+
+def get_blockers(names=None):
+    """Get a list of ``(name, function)`` blocking key generators. Extra
+    blockers can be registered as ``corpint.blocking`` entry points."""
+    blockers = OrderedDict(BLOCKERS)
+    blockers.update(get_extensions('corpint.blocking'))
+    if not names:
+        return list(blockers.items())
+    selected = []
+    for name in names:
+        if name not in blockers:
+            raise RuntimeError("Blocker not found: %s" % name)
+        selected.append((name, blockers[name]))
+    return selected
+
+
+def generate_blocks(entities, blockers):
+    """Map each blocking key to the positions of the entities which
+    generate it."""
+    blocks = defaultdict(list)
+    for idx, entity in enumerate(entities):
+        for name, func in blockers:
+            for key in set(func(entity)):
+                blocks[(name, key)].append(idx)
+    return blocks
+
+
+def generate_pairs(entities, blockers, max_block_size=200, include=None):
+    """Generate the positions of each pair of entities sharing a blocking
+    key once. Blocks larger than ``max_block_size`` are too unspecific and
+    are skipped. ``include`` can limit the pairs to those with at least
+    one entity for which it returns true.
+
+    The entities are only read before the first pair is generated."""
+    blocks = generate_blocks(entities, blockers)
+    log.info("Generated %d blocks from %d entities.",
+             len(blocks), len(entities))
+    included = None
+    if include is not None:
+        included = [bool(include(e)) for e in entities]
+    seen = set()
+    skipped = 0
+    for key, members in blocks.items():
+        if len(members) < 2:
+            continue
+        if len(members) > max_block_size:
+            skipped += 1
+            continue
+        for pair in combinations(members, 2):
+            if pair in seen:
+                continue
+            seen.add(pair)
+            if included is not None and \
+               not included[pair[0]] and not included[pair[1]]:
+                continue
+            yield pair
+    if skipped > 0:
+        log.info("Skipped %d oversized blocks.", skipped)
@@ -0,0 +1,170 @@
+from collections import defaultdict
+from sqlalchemy import Column, Unicode, text
+
+from corpint.core import session, project
+from corpint.model.common import Base, UID_LENGTH
+from corpint.model.state import State
+
+STATE_KEY = u'clusters'
+VERSION_KEY = u'clusters.version'
+BUILT = u'built'
+STALE = u'stale'
+
+
+class UnionFind(object):
+    """Disjoint-set forest with path compression and union by size."""
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+            return item
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        return ra
+
+    def clusters(self):
+        """Return a list of sets of items which have been joined."""
+        groups = defaultdict(set)
+        for item in self.parent:
+            groups[self.find(item)].add(item)
+        return list(groups.values())
+
+
+class Cluster(Base):
+    """Persisted cluster membership: every entity which has a positive
+    judgement points straight at the canonical (i.e. highest) UID of its
+    cluster."""
+    __tablename__ = 'cluster'
+
+    project = Column(Unicode(255), primary_key=True)
+    uid = Column(Unicode(UID_LENGTH), primary_key=True)
+    canonical_uid = Column(Unicode(UID_LENGTH), index=True, nullable=False)
+
+    @classmethod
+    def find(cls):
+        q = session.query(cls)
+        q = q.filter(cls.project == project.name)
+        return q
+
+    @classmethod
+    def is_built(cls):
+        return State.get(STATE_KEY) == BUILT
+
+    @classmethod
+    def version(cls):
+        """A counter which changes whenever the clusters change."""
+        return int(State.get(VERSION_KEY, 0))
+
+    @classmethod
+    def touch(cls):
+        State.increment(VERSION_KEY)
+
+    @classmethod
+    def invalidate(cls):
+        """Mark the clusters for a full rebuild, e.g. because a positive
+        judgement was retracted."""
+        State.set(STATE_KEY, STALE)
+        cls.touch()
+
+    @classmethod
+    def lock(cls):
+        """Hold a lock on the clusters of the project until the end of the
+        transaction, so that concurrent merges see each other's rows."""
+        if session.get_bind().dialect.name != 'postgresql':
+            return
+        key = u'corpint.clusters:%s' % project.name
+        session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+                        {'key': key})
+
+    @classmethod
+    def rebuild(cls, pairs):
+        """Re-generate all clusters from a list of positive pairs."""
+        cls.lock()
+        forest = UnionFind()
+        for (uida, uidb) in pairs:
+            forest.union(uida, uidb)
+
+        cls.find().delete(synchronize_session=False)
+        rows = []
+        for uids in forest.clusters():
+            canonical_uid = max(uids)
+            for uid in uids:
+                rows.append({
+                    'project': project.name,
+                    'uid': uid,
+                    'canonical_uid': canonical_uid
+                })
+        if len(rows):
+            session.execute(cls.__table__.insert(), rows)
+        State.set(STATE_KEY, BUILT)
+        cls.touch()
+        return len(rows)
+
+    @classmethod
+    def merge(cls, uida, uidb):
+        """Apply a single positive judgement to the stored clusters."""
+        cls.lock()
+        if not cls.is_built():
+            # The next full rebuild will include this pair.
+            return
+        q = session.query(cls.uid, cls.canonical_uid)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.uid.in_([uida, uidb]))
+        known = dict(q.all())
+        roots = [known.get(uida, uida), known.get(uidb, uidb)]
+        canonical_uid, other_uid = max(roots), min(roots)
+        if canonical_uid == other_uid and uida in known and uidb in known:
+            return
+        if canonical_uid != other_uid:
+            q = cls.find().filter(cls.canonical_uid == other_uid)
+            q.update({cls.canonical_uid: canonical_uid},
+                     synchronize_session=False)
+        rows = []
+        for uid in set([uida, uidb]):
+            if uid not in known:
+                rows.append({
+                    'project': project.name,
+                    'uid': uid,
+                    'canonical_uid': canonical_uid
+                })
+        if len(rows):
+            session.execute(cls.__table__.insert(), rows)
+        cls.touch()
+
+    @classmethod
+    def get_canonical_uids(cls):
+        """Get a dict mapping each clustered UID to its canonical UID."""
+        q = session.query(cls.uid, cls.canonical_uid)
+        q = q.filter(cls.project == project.name)
+        return dict(q.yield_per(10000))
+
+    @classmethod
+    def find_clusters(cls):
+        """Get a list of sets of entity UIDs, one for each cluster."""
+        clusters = defaultdict(set)
+        q = session.query(cls.uid, cls.canonical_uid)
+        q = q.filter(cls.project == project.name)
+        for (uid, canonical_uid) in q.yield_per(10000):
+            clusters[canonical_uid].add(uid)
+        return list(clusters.values())
+
+    def __repr__(self):
+        return '<Cluster(%r, %r)>' % (self.uid, self.canonical_uid)
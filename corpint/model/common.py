@@ -1,10 +1,16 @@
+import threading
+import fingerprints
 from hashlib import sha1
+from collections import OrderedDict
 from normality import stringify
 from dalet import parse_country
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 UID_LENGTH = len(sha1().hexdigest())
+FINGERPRINT_CACHE = OrderedDict()
+FINGERPRINT_CACHE_SIZE = 100000
+lock = threading.Lock()
 
 
 def is_list(obj):
@@ -20,6 +26,32 @@ def ensure_list(obj):
     return obj
 
 
+def fingerprint(name):
+    """Memoized ``fingerprints.generate``, keeping the most recently used
+    names."""
+    with lock:
+        if name in FINGERPRINT_CACHE:
+            fp = FINGERPRINT_CACHE.pop(name)
+            FINGERPRINT_CACHE[name] = fp
+            return fp
+    fp = fingerprints.generate(name)
+    with lock:
+        FINGERPRINT_CACHE[name] = fp
+        while len(FINGERPRINT_CACHE) > FINGERPRINT_CACHE_SIZE:
+            FINGERPRINT_CACHE.popitem(last=False)
+    return fp
+
+
+def name_fingerprints(names):
+    """Get the set of fingerprints for a list of names."""
+    fps = set()
+    for name in names:
+        fp = fingerprint(name)
+        if fp is not None:
+            fps.add(fp)
+    return fps
+
+
 class SchemaObject(object):
     MULTI = ['aliases']
 
@@ -1,5 +1,7 @@
 import logging
+from time import time
 from hashlib import sha1
+from collections import OrderedDict, defaultdict
 from normality import stringify
 
 from corpint.core import session, project
@@ -35,24 +37,42 @@ class Emitter(object):
             raise ValueError("No unique key given!")
         return unicode(uid.hexdigest())
 
+    def save_entity(self, data):
+        """Write an entity to the session without committing."""
+        return Entity.save(dict(data), self.origin,
+                           query_uid=self.query_uid,
+                           match_uid=self.match_uid)
+
+    def save_entities(self, records):
+        """Write many entities to the session in bulk, without committing."""
+        return Entity.save_many(records, self.origin,
+                                query_uid=self.query_uid,
+                                match_uid=self.match_uid)
+
+    def save_link(self, data):
+        """Write a link to the session without committing."""
+        return Link.save(dict(data), self.origin)
+
+    def save_document(self, entity_uid, url, title, publisher=None):
+        """Write a document to the session without committing."""
+        return Document.save(entity_uid, url, title, self.origin,
+                             publisher=publisher)
+
     def emit_entity(self, data):
         """Create or update an entity in the context of this emitter."""
-        entity = Entity.save(dict(data), self.origin,
-                             query_uid=self.query_uid,
-                             match_uid=self.match_uid)
+        entity = self.save_entity(data)
         session.commit()
         return entity
 
     def emit_link(self, data):
         """Create or update a link in the context of this emitter."""
-        entity = Link.save(dict(data), self.origin)
+        link = self.save_link(data)
         session.commit()
-        return entity
+        return link
 
     def emit_document(self, entity_uid, url, title, publisher=None):
         """Create or update a document in the context of this emitter."""
-        doc = Document.save(entity_uid, url, title, self.origin,
-                            publisher=publisher)
+        doc = self.save_document(entity_uid, url, title, publisher=publisher)
         session.commit()
         return doc
 
@@ -73,6 +93,14 @@ class Emitter(object):
                                 match_uid=self.match_uid)
         session.commit()
 
+    def batch(self, size=5000):
+        """Buffer emitted records and write them in bulk, e.g.:
+
+            with project.origin('x').batch(size=5000) as emitter:
+                emitter.emit_entity({...})
+        """
+        return BatchEmitter(self, Batch(size=size))
+
 
 class OriginEmitter(Emitter):
     """Generate entities without a result context."""
@@ -98,10 +126,10 @@ class ResultEmitter(Emitter):
                                             query_uid=query_uid,
                                             match_uid=match_uid)
 
-    def emit_entity(self, data):
+    def save_entity(self, data):
         # Enrichment results are first held as inactive and become active only
         # once the judgement between the query and result entities is confirmed
-        entity = super(ResultEmitter, self).emit_entity(data)
+        entity = super(ResultEmitter, self).save_entity(data)
         if (self.mapping is None) or \
            (not self.mapping.decided) or \
            (self.mapping.judgement is False):
@@ -115,10 +143,155 @@ class ResultEmitter(Emitter):
                 if query is not None:
                     Mapping.save(self.match_uid, self.query_uid, None,
                                  score=query.compare(entity))
-        session.commit()
         return entity
 
+    def save_entities(self, records):
+        # Results need the per-entity activation logic above.
+        for data in records:
+            self.save_entity(data)
+        return len(records)
+
     def __repr__(self):
         return '<ResultEmitter(%r, %r, %r)>' % (self.origin,
                                                 self.query_uid,
                                                 self.match_uid)
+
+
+class Batch(object):
+    """A buffer of pending writes, shared by all emitters in a batch."""
+
+    def __init__(self, size=5000):
+        self.size = max(1, int(size))
+        self.total = 0
+        self.started = time()
+        self.reset()
+
+    def reset(self):
+        self.entities = []
+        self.links = []
+        self.documents = []
+        self.entity_keys = defaultdict(set)
+
+    def __len__(self):
+        return len(self.entities) + len(self.links) + len(self.documents)
+
+    def add_entity(self, emitter, data):
+        key = (emitter.query_uid, emitter.match_uid)
+        self.entity_keys[data.get('uid')].add(key)
+        self.entities.append((emitter, data))
+        self.check()
+
+    def add_link(self, emitter, data):
+        self.links.append((emitter, data))
+        self.check()
+
+    def add_document(self, emitter, *args, **kwargs):
+        self.documents.append((emitter, args, kwargs))
+        self.check()
+
+    def has_entity(self, uid, query_uid=None, match_uid=None):
+        """Check if an entity is waiting to be written."""
+        keys = self.entity_keys.get(uid)
+        if not keys:
+            return False
+        if query_uid is None or match_uid is None:
+            return True
+        return (query_uid, match_uid) in keys
+
+    def check(self):
+        if len(self) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Write all pending records in a single transaction."""
+        count = len(self)
+        if count == 0:
+            return
+        entities, links, documents = self.entities, self.links, self.documents
+        self.reset()
+        grouped = OrderedDict()
+        for emitter, data in entities:
+            if id(emitter) not in grouped:
+                grouped[id(emitter)] = (emitter, [])
+            grouped[id(emitter)][1].append(data)
+        try:
+            for emitter, records in grouped.values():
+                emitter.save_entities(records)
+            for emitter, data in links:
+                emitter.save_link(data)
+            for emitter, args, kwargs in documents:
+                emitter.save_document(*args, **kwargs)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.total += count
+        elapsed = max(time() - self.started, 0.001)
+        project.log.info("Flushed %d rows (%d total, %.1f rows/sec)",
+                         count, self.total, self.total / elapsed)
+
+    def discard(self):
+        self.reset()
+        session.rollback()
+
+
+class BatchEmitter(object):
+    """Wrap an emitter so that its writes are buffered in a ``Batch``.
+
+    Records become visible in the database once the batch is flushed,
+    either because it is full or because the context manager exits.
+    """
+
+    def __init__(self, emitter, batch):
+        self.emitter = emitter
+        self.batch = batch
+
+    def __getattr__(self, name):
+        return getattr(self.emitter, name)
+
+    def emit_entity(self, data):
+        """Queue an entity for writing."""
+        self.batch.add_entity(self.emitter, dict(data))
+
+    def emit_link(self, data):
+        """Queue a link for writing."""
+        self.batch.add_link(self.emitter, dict(data))
+
+    def emit_document(self, entity_uid, url, title, publisher=None):
+        """Queue a document for writing."""
+        self.batch.add_document(self.emitter, entity_uid, url, title,
+                                publisher=publisher)
+
+    def emit_judgement(self, uida, uidb, judgement, score=None,
+                       decided=False):
+        """Judgements are written immediately, flushing the batch first."""
+        self.flush()
+        return self.emitter.emit_judgement(uida, uidb, judgement,
+                                           score=score, decided=decided)
+
+    def entity_exists(self, uid):
+        """Check the pending batch before asking the database."""
+        if self.batch.has_entity(uid, query_uid=self.emitter.query_uid,
+                                 match_uid=self.emitter.match_uid):
+            return True
+        return self.emitter.entity_exists(uid)
+
+    def result(self, query_uid, match_uid):
+        """Create a result emitter which shares this batch."""
+        return BatchEmitter(self.emitter.result(query_uid, match_uid),
+                            self.batch)
+
+    def flush(self):
+        self.batch.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.batch.discard()
+
+    def __repr__(self):
+        return '<BatchEmitter(%r)>' % (self.emitter,)
@@ -0,0 +1,90 @@
+import json
+from hashlib import sha1
+from datetime import datetime, timedelta
+from sqlalchemy import Column, Unicode, DateTime
+
+from corpint.core import session, project
+from corpint.model.common import Base, UID_LENGTH
+
+# Entity fields which enrichers use to build their queries.
+QUERY_FIELDS = ['registration_number', 'address']
+QUERY_PREFIXES = ['wikipedia_']
+
+
+class Enrichment(Base):
+    """Records when an enricher last ran successfully for a composite
+    entity, and on which inputs."""
+    __tablename__ = 'enrichment'
+
+    project = Column(Unicode(255), primary_key=True)
+    enricher = Column(Unicode(255), primary_key=True)
+    canonical_uid = Column(Unicode(UID_LENGTH), primary_key=True)
+    input_hash = Column(Unicode(UID_LENGTH), nullable=False)
+    enriched_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def input_hash_for(cls, entity):
+        """Hash the fields of a composite entity used in queries."""
+        inputs = {
+            'schema': entity.schema,
+            'names': sorted([n for n in entity.names if n is not None]),
+            'country': entity.country,
+        }
+        for field, value in entity.data.items():
+            if field in QUERY_FIELDS or \
+               any([field.startswith(p) for p in QUERY_PREFIXES]):
+                inputs[field] = value
+        inputs = json.dumps(inputs, sort_keys=True)
+        return unicode(sha1(inputs.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def load(cls, enricher):
+        """Get the stored state of an enricher, by canonical UID."""
+        q = session.query(cls.canonical_uid, cls.input_hash,
+                          cls.enriched_at)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.enricher == enricher)
+        return {uid: (h, at) for (uid, h, at) in q.yield_per(10000)}
+
+    @classmethod
+    def save(cls, enricher, entity):
+        obj = session.query(cls).get((project.name, enricher, entity.uid))
+        if obj is None:
+            obj = cls()
+            obj.project = project.name
+            obj.enricher = enricher
+            obj.canonical_uid = entity.uid
+        obj.input_hash = cls.input_hash_for(entity)
+        obj.enriched_at = datetime.utcnow()
+        session.add(obj)
+        return obj
+
+    def __repr__(self):
+        return '<Enrichment(%r, %r)>' % (self.enricher, self.canonical_uid)
+
+
+class EnrichmentState(object):
+    """Decide which entities an enricher can skip because their inputs
+    have not changed since they were last enriched."""
+
+    def __init__(self, enricher, force=False, max_age=None):
+        self.enricher = enricher
+        self.force = force
+        self.cutoff = None
+        if max_age is not None:
+            self.cutoff = datetime.utcnow() - timedelta(days=max_age)
+        self.state = {} if force else Enrichment.load(enricher)
+
+    def is_fresh(self, entity):
+        if self.force or entity.uid not in self.state:
+            return False
+        input_hash, enriched_at = self.state[entity.uid]
+        if input_hash != Enrichment.input_hash_for(entity):
+            return False
+        if self.cutoff is not None and enriched_at < self.cutoff:
+            return False
+        return True
+
+    def mark(self, entity):
+        Enrichment.save(self.enricher, entity)
+        session.commit()
@@ -1,19 +1,26 @@
 import Levenshtein
-import fingerprints
-from sqlalchemy import Column, Unicode, Boolean, Integer
-from sqlalchemy.dialects.postgresql import JSONB
+from datetime import datetime
+from sqlalchemy import Column, Unicode, Boolean, Integer, DateTime
+from sqlalchemy import Index, func
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert
 from itertools import product
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 from dalet import parse_boolean
 
 from corpint.core import session, project
 from corpint.model.common import Base, SchemaObject, UID_LENGTH
+from corpint.model.common import name_fingerprints
 from corpint.model.schema import choose_best_schema
 from corpint.model.schema import TYPES, ASSET, PERSON, BANK_ACCOUNT
 from corpint.model.address import Address
 
 IDENTIFIERS = ['aleph_id', 'opencorporates_url', 'bvd_id', 'wikidata_id']
 
+# The fields of an entity needed to build a composite.
+EntityRow = namedtuple('EntityRow', ['uid', 'canonical_uid', 'origin',
+                                     'schema', 'tasked', 'data'])
+
 
 class EntityCore(SchemaObject):
 
@@ -37,45 +44,54 @@ class EntityCore(SchemaObject):
     @property
     def fingerprints(self):
         if not hasattr(self, '_fingerprints'):
-            self._fingerprints = set()
-            for name in self.names:
-                fp = fingerprints.generate(name)
-                if fp is not None:
-                    self._fingerprints.add(fp)
+            self._fingerprints = name_fingerprints(self.names)
         return self._fingerprints
 
+    @property
+    def features(self):
+        """A compact, picklable tuple of the fields used for matching."""
+        ids = tuple([self.data.get(i) for i in IDENTIFIERS])
+        return (self.uid, tuple(self.fingerprints), self.country,
+                self.schema, bool(self.tasked), ids,
+                self.data.get('registration_number'),
+                self.data.get('identifier'))
+
     def compare(self, other):
-        for identifier in IDENTIFIERS:
-            ids = self.data.get(identifier), other.data.get('identifier')
-            if None not in ids and len(set(ids)) == 1:
-                return 2.0
+        return compare_features(self.features, other.features)
+
+
+def compare_features(left, right):
+    """Score the similarity of two entities, given as ``features``."""
+    (_, lfps, lcountry, lschema, ltasked, lids, lregnr, _) = left
+    (_, rfps, rcountry, rschema, rtasked, _, rregnr, ridentifier) = right
+    # Each identifier is compared to the 'identifier' field of the other.
+    for lid in lids:
+        if lid is not None and lid == ridentifier:
+            return 2.0
 
-        schemata = set([self.schema, other.schema])
-        if len(schemata.intersection([BANK_ACCOUNT, ASSET])):
-            return 0
+    schemata = set([lschema, rschema])
+    if len(schemata.intersection([BANK_ACCOUNT, ASSET])):
+        return 0
 
-        score = 0
-        for lfp, rfp in product(self.fingerprints, other.fingerprints):
-            distance = Levenshtein.distance(lfp, rfp)
-            lscore = 1 - (distance / float(max(len(lfp), len(rfp))))
-            score = max(score, lscore)
+    score = 0
+    for lfp, rfp in product(lfps, rfps):
+        distance = Levenshtein.distance(lfp, rfp)
+        lscore = 1 - (distance / float(max(len(lfp), len(rfp))))
+        score = max(score, lscore)
 
-        if PERSON not in schemata:
-            score *= .95
+    if PERSON not in schemata:
+        score *= .95
 
-        countries = self.country, other.country
-        if None in countries or len(set(countries)) != 1:
-            score *= .95
+    if lcountry is None or rcountry is None or lcountry != rcountry:
+        score *= .95
 
-        regnr = (self.data.get('registration_number'),
-                 other.data.get('registration_number'))
-        if None not in regnr and len(set(regnr)) == 1:
-            score *= 1.1
+    if lregnr is not None and lregnr == rregnr:
+        score *= 1.1
 
-        if not self.tasked and not other.tasked:
-            score *= .95
+    if not ltasked and not rtasked:
+        score *= .95
 
-        return min(1.0, score)
+    return min(1.0, score)
 
 
 class CompositeEntity(EntityCore):
@@ -141,6 +157,35 @@ class Entity(EntityCore, Base):
     tasked = Column(Boolean, default=False)
     active = Column(Boolean, default=True)
     data = Column(JSONB, default={})
+    updated_at = Column(DateTime, default=datetime.utcnow,
+                        onupdate=datetime.utcnow, index=True)
+    name_fingerprints = Column(ARRAY(Unicode), nullable=True)
+
+    # One row per uid within a result context; the origin context (no
+    # query_uid/match_uid) is coalesced so that NULLs do not count as
+    # distinct.
+    __table_args__ = (
+        Index('ix_entity_result_uid', project, uid,
+              func.coalesce(query_uid, ''), func.coalesce(match_uid, ''),
+              unique=True),
+        Index('ix_entity_name_fingerprints', name_fingerprints,
+              postgresql_using='gin'),
+    )
+    UPSERT_FIELDS = ['origin', 'schema', 'tasked', 'active', 'data',
+                     'name_fingerprints', 'updated_at']
+
+    @property
+    def fingerprints(self):
+        # Stored when the entity is saved, computed for older rows.
+        if self.name_fingerprints is not None:
+            return set(self.name_fingerprints)
+        return super(Entity, self).fingerprints
+
+    @classmethod
+    def generate_fingerprints(cls, data):
+        names = list(data.get('aliases', []))
+        names.append(data.get('name'))
+        return sorted(name_fingerprints(names))
 
     def delete(self):
         # Keeping the mappings.
@@ -169,12 +214,93 @@ class Entity(EntityCore, Base):
         obj.tasked = parse_boolean(data.pop('tasked', None), default=False)
         obj.active = parse_boolean(data.pop('active', None), default=True)
         obj.data = obj.parse_data(data)
+        obj.name_fingerprints = cls.generate_fingerprints(obj.data)
         session.add(obj)
 
         Address.delete_by_entity(uid)
         Address.save(uid, obj.data.get('address'), origin)
         return obj
 
+    @classmethod
+    def save_many(cls, records, origin, query_uid=None, match_uid=None,
+                  chunk_size=1000):
+        """Create or update many entities (and their addresses) at once,
+        without loading existing rows. Returns the number of entities."""
+        parser = cls()
+        now = datetime.utcnow()
+        rows = OrderedDict()
+        for data in records:
+            data = dict(data)
+            uid = data.pop('uid', None)
+            if uid is None:
+                raise ValueError("No UID on entity: %r" % data)
+            schema = data.pop('schema', None)
+            if schema not in TYPES:
+                raise ValueError("Invalid entity type: %r", data)
+            tasked = parse_boolean(data.pop('tasked', None), default=False)
+            active = parse_boolean(data.pop('active', None), default=True)
+            data = parser.parse_data(data)
+            rows[uid] = {
+                'project': project.name,
+                'origin': origin,
+                'uid': uid,
+                'canonical_uid': uid,
+                'query_uid': query_uid,
+                'match_uid': match_uid,
+                'schema': schema,
+                'tasked': tasked,
+                'active': active,
+                'data': data,
+                'name_fingerprints': cls.generate_fingerprints(data),
+                'updated_at': now
+            }
+
+        rows = list(rows.values())
+        dialect = session.get_bind().dialect.name
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            if dialect == 'postgresql':
+                cls._upsert_postgresql(chunk)
+            else:
+                cls._upsert_generic(chunk, query_uid, match_uid)
+            uids = [r['uid'] for r in chunk]
+            Address.delete_by_entities(uids)
+            Address.save_many([(r['uid'], r['data'].get('address'))
+                               for r in chunk], origin)
+        return len(rows)
+
+    @classmethod
+    def _upsert_postgresql(cls, rows):
+        stmt = insert(cls.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.project, cls.uid,
+                            func.coalesce(cls.query_uid, ''),
+                            func.coalesce(cls.match_uid, '')],
+            set_={f: getattr(stmt.excluded, f) for f in cls.UPSERT_FIELDS}
+        )
+        session.execute(stmt)
+
+    @classmethod
+    def _upsert_generic(cls, rows, query_uid, match_uid):
+        # Fallback for databases without ON CONFLICT support (e.g. SQLite):
+        # look up all existing rows of the chunk in one query.
+        q = session.query(cls.uid, cls.id)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.uid.in_([r['uid'] for r in rows]))
+        q = q.filter(cls.query_uid == query_uid)
+        q = q.filter(cls.match_uid == match_uid)
+        existing = dict(q.all())
+        inserts, updates = [], []
+        for row in rows:
+            if row['uid'] in existing:
+                update = {f: row[f] for f in cls.UPSERT_FIELDS}
+                update['id'] = existing[row['uid']]
+                updates.append(update)
+            else:
+                inserts.append(row)
+        session.bulk_insert_mappings(cls, inserts)
+        session.bulk_update_mappings(cls, updates)
+
     @classmethod
     def get(cls, uid, query_uid=None, match_uid=None):
         q = cls.find_by_result(query_uid=query_uid, match_uid=match_uid)
@@ -190,6 +316,13 @@ class Entity(EntityCore, Base):
             q = q.filter(cls.match_uid == match_uid)
         return q
 
+    @classmethod
+    def find_by_uids(cls, uids):
+        q = session.query(cls)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.uid.in_(uids))
+        return q
+
     @classmethod
     def find_by_origins(cls, origins):
         q = session.query(cls)
@@ -208,7 +341,7 @@ class Entity(EntityCore, Base):
             entity.delete()
 
     @classmethod
-    def iter_composite(cls, origins=[], tasked=None):
+    def _composite_query(cls, query, origins=[], tasked=None):
         sq = session.query(cls.canonical_uid.distinct())
         sq = sq.filter(cls.project == project.name)
         sq = sq.filter(cls.active == True)  # noqa
@@ -216,22 +349,68 @@ class Entity(EntityCore, Base):
             sq = sq.filter(cls.origin.in_(origins))
         if tasked is not None:
             sq = sq.filter(cls.tasked == tasked)
-        q = session.query(cls)
-        q = q.filter(cls.project == project.name)
+        q = query.filter(cls.project == project.name)
         q = q.filter(cls.active == True)  # noqa
         q = q.filter(cls.canonical_uid.in_(sq))
         q = q.order_by(cls.canonical_uid.asc())
-        entities = []
-        canonical_uid = None
-        for entity in q:
-            if entity.canonical_uid != canonical_uid:
-                if len(entities):
-                    yield CompositeEntity(entities)
-                entities = []
-            entities.append(entity)
+        return q
+
+    @classmethod
+    def _group_composite(cls, entities):
+        group, canonical_uid = [], None
+        for entity in entities:
+            if entity.canonical_uid != canonical_uid and len(group):
+                yield group
+                group = []
+            group.append(entity)
             canonical_uid = entity.canonical_uid
-        if len(entities):
-            yield CompositeEntity(entities)
+        if len(group):
+            yield group
+
+    @classmethod
+    def iter_composite(cls, origins=[], tasked=None, rows=False,
+                       chunk_size=1000):
+        """Generate a ``CompositeEntity`` for each canonical UID.
+
+        Entities are streamed from a server-side cursor on a separate
+        connection, so that consumers can commit while iterating. With
+        ``rows=True``, composites are made from plain row tuples instead
+        of ORM instances."""
+        if rows:
+            entities = cls._iter_rows(origins, tasked, chunk_size)
+            for group in cls._group_composite(entities):
+                yield CompositeEntity(group)
+            return
+
+        reader = Session(bind=session.get_bind())
+        try:
+            q = cls._composite_query(reader.query(cls), origins=origins,
+                                     tasked=tasked)
+            q = q.execution_options(stream_results=True)
+            for group in cls._group_composite(q.yield_per(chunk_size)):
+                yield CompositeEntity(group)
+                for entity in group:
+                    reader.expunge(entity)
+        finally:
+            reader.close()
+
+    @classmethod
+    def _iter_rows(cls, origins, tasked, chunk_size):
+        columns = [getattr(cls, f) for f in EntityRow._fields]
+        q = cls._composite_query(session.query(*columns), origins=origins,
+                                 tasked=tasked)
+        conn = session.get_bind().connect()
+        try:
+            conn = conn.execution_options(stream_results=True)
+            result = conn.execute(q.statement)
+            while True:
+                chunk = result.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield EntityRow(*row)
+        finally:
+            conn.close()
 
     def __repr__(self):
         return '<Entity(%r)>' % self.uid
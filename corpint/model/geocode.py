@@ -0,0 +1,58 @@
+from datetime import datetime
+from sqlalchemy import Column, Unicode, Float, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from corpint.core import session
+from corpint.model.common import Base
+
+
+class Geocode(Base):
+    """Geocoder results by address slug, including addresses which could
+    not be found. Results are shared by all projects."""
+    __tablename__ = 'geocode'
+
+    backend = Column(Unicode(255), primary_key=True)
+    slug = Column(Unicode(), primary_key=True)
+    normalized = Column(Unicode(), nullable=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    geocoded_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    UPDATE_FIELDS = ['normalized', 'latitude', 'longitude', 'geocoded_at']
+
+    @property
+    def found(self):
+        return self.normalized is not None
+
+    @classmethod
+    def find_by_slugs(cls, backend, slugs):
+        """Get the cached results for a list of slugs, by slug."""
+        q = session.query(cls)
+        q = q.filter(cls.backend == backend)
+        q = q.filter(cls.slug.in_(slugs))
+        return {g.slug: g for g in q}
+
+    @classmethod
+    def save(cls, backend, slug, result=None):
+        """Store the result for a slug. Concurrent workers can geocode the
+        same slug, so this is an upsert."""
+        result = result or {}
+        values = {
+            'backend': backend,
+            'slug': slug,
+            'normalized': result.get('normalized'),
+            'latitude': result.get('latitude'),
+            'longitude': result.get('longitude'),
+            'geocoded_at': datetime.utcnow()
+        }
+        if session.get_bind().dialect.name != 'postgresql':
+            return session.merge(cls(**values))
+        stmt = insert(cls.__table__).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.backend, cls.slug],
+            set_={f: getattr(stmt.excluded, f) for f in cls.UPDATE_FIELDS}
+        )
+        session.execute(stmt)
+        return cls(**values)
+
+    def __repr__(self):
+        return '<Geocode(%r, %r)>' % (self.slug, self.normalized)
@@ -1,35 +1,117 @@
-from whoosh.filedb.filestore import RamStorage
+import os
+from datetime import datetime, timedelta
+from whoosh.filedb.filestore import RamStorage, FileStorage
 from whoosh.qparser import QueryParser
 from whoosh.query import Term
+from whoosh.writing import CLEAR
 from whoosh.fields import Schema, TEXT, ID, KEYWORD
 
-from corpint.core import project
+from corpint.core import project, session
 from corpint.model.entity import Entity
 
 schema = Schema(uid=ID(stored=True), fingerprint=TEXT,
                 country=KEYWORD, name=TEXT(stored=True))
 
+WATERMARK_FILE = 'watermark'
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# ``updated_at`` is set when a row is flushed, not when it is committed,
+# so a row can become visible with a time before the last watermark.
+# Entities changed within this window of it are indexed again.
+WATERMARK_LAG = timedelta(hours=1)
+
 
 class EntityIndex(object):
+    """A search index of entity fingerprints. If a ``path`` is given, the
+    index is kept on disk and only updated with the entities which have
+    changed since it was last used."""
+
+    def __init__(self, path=None):
+        self.path = path
+        if path is None:
+            self.index = RamStorage().create_index(schema)
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        storage = FileStorage(path)
+        if storage.index_exists():
+            self.index = storage.open_index()
+        else:
+            self.index = storage.create_index(schema)
+
+    @property
+    def watermark(self):
+        if self.path is None:
+            return None
+        watermark_path = os.path.join(self.path, WATERMARK_FILE)
+        if not os.path.exists(watermark_path):
+            return None
+        with open(watermark_path, 'r') as fh:
+            return datetime.strptime(fh.read().strip(), WATERMARK_FORMAT)
 
-    def __init__(self):
-        storage = RamStorage()
-        self.index = storage.create_index(schema)
+    @watermark.setter
+    def watermark(self, value):
+        if self.path is None or value is None:
+            return
+        watermark_path = os.path.join(self.path, WATERMARK_FILE)
+        with open(watermark_path, 'w') as fh:
+            fh.write(value.strftime(WATERMARK_FORMAT))
+
+    def add_entity(self, writer, entity):
+        for fp in entity.fingerprints:
+            writer.add_document(uid=entity.uid, fingerprint=fp,
+                                country=entity.country, name=entity.name)
 
     def build(self):
+        """Re-index all active entities from scratch."""
         project.log.info("Building entity search index...")
         writer = self.index.writer()
         q = Entity.find_by_origins(origins=[])
         q = q.filter(Entity.active == True)  # noqa
-        count = 0
-        for entity in q:
-            for fp in entity.fingerprints:
-                writer.add_document(uid=entity.uid, fingerprint=fp,
-                                    country=entity.country, name=entity.name)
+        count, watermark = 0, None
+        for entity in q.yield_per(10000):
+            self.add_entity(writer, entity)
+            watermark = max(watermark, entity.updated_at)
             count += 1
-        writer.commit()
+        writer.commit(mergetype=CLEAR)
+        self.watermark = watermark
         project.log.info("Indexed %s entities.", count)
 
+    def update(self):
+        """Re-index entities changed since the last update and remove
+        those which have been deleted."""
+        watermark = self.watermark
+        if watermark is None:
+            return self.build()
+
+        q = session.query(Entity.uid, Entity.updated_at)
+        q = q.filter(Entity.project == project.name)
+        q = q.filter(Entity.updated_at >= watermark - WATERMARK_LAG)
+        changed = set()
+        for (uid, updated_at) in q.yield_per(10000):
+            changed.add(uid)
+            watermark = max(watermark, updated_at)
+
+        q = session.query(Entity.uid)
+        q = q.filter(Entity.project == project.name)
+        existing = set([uid for (uid,) in q.yield_per(10000)])
+        with self.index.reader() as reader:
+            indexed = set([u.decode('utf-8') for u in reader.lexicon('uid')])
+        deleted = indexed - existing
+
+        writer = self.index.writer()
+        for uid in changed.union(deleted):
+            writer.delete_by_term('uid', uid)
+        changed = list(changed)
+        for i in range(0, len(changed), 1000):
+            q = Entity.find_by_uids(changed[i:i + 1000])
+            q = q.filter(Entity.active == True)  # noqa
+            for entity in q:
+                self.add_entity(writer, entity)
+        writer.commit()
+        self.watermark = watermark
+        project.log.info("Index update: %d changed, %d deleted entities.",
+                         len(changed), len(deleted))
+
     def search_similar(self, entity, skip=[]):
         with self.index.searcher() as searcher:
             qp = QueryParser("fingerprint", schema=self.index.schema)
@@ -1,12 +1,19 @@
 from itertools import chain
 from sqlalchemy import Column, Unicode, Boolean, Float
+from sqlalchemy import select, func, or_
 
 from corpint.core import session, project
 from corpint.model.entity import Entity
 from corpint.model.link import Link
 from corpint.model.index import EntityIndex
+from corpint.model.blocking import get_blockers, generate_pairs
+from corpint.model.scoring import score_pairs, compare_many
+from corpint.model.cluster import Cluster
+from corpint.model.state import State
 from corpint.model.common import Base, UID_LENGTH
 
+CANONICAL_KEY = u'canonical.version'
+
 
 class Mapping(Base):
     __tablename__ = 'mapping'
@@ -49,6 +56,7 @@ class Mapping(Base):
             obj.project = project.name
             obj.left_uid = left_uid
             obj.right_uid = right_uid
+        previous = obj.judgement
         obj.judgement = judgement
         if judgement is not None:
             decided = True
@@ -58,6 +66,13 @@ class Mapping(Base):
             obj.score = float(score)
         session.add(obj)
 
+        # Keep the stored clusters up to date. Merging is cheap, but a
+        # retracted positive judgement may split a cluster.
+        if judgement is True and previous is not True:
+            Cluster.merge(left_uid, right_uid)
+        elif previous is True and judgement is not True:
+            Cluster.invalidate()
+
         # Set entities to enabled.
         if obj.decided:
             entities = chain(
@@ -111,20 +126,23 @@ class Mapping(Base):
         return q
 
     @classmethod
-    def generate_clusters(cls):
-        """Get a list of lists of entities which are identical."""
-        clusters = []
-        for pair in cls.find_judgements(True):
-            new_clusters = []
-            cluster = set(pair)
-            for cand in clusters:
-                if cluster.isdisjoint(cand):
-                    new_clusters.append(cand)
-                else:
-                    cluster = cluster.union(cand)
-            new_clusters.append(cluster)
-            clusters = new_clusters
-        return clusters
+    def update_clusters(cls, rebuild=False):
+        """Make sure the stored clusters reflect all judgements.
+
+        Clusters are updated as judgements are emitted; they are only
+        re-generated from all positive judgements when first used or after
+        a positive judgement has been retracted."""
+        if rebuild or not Cluster.is_built():
+            project.log.info("Rebuilding entity clusters...")
+            count = Cluster.rebuild(cls.find_judgements(True))
+            project.log.info("Clustered %d entities.", count)
+            session.commit()
+
+    @classmethod
+    def generate_clusters(cls, rebuild=False):
+        """Get a list of sets of entities which are identical."""
+        cls.update_clusters(rebuild=rebuild)
+        return Cluster.find_clusters()
 
     @classmethod
     def get_decisions(cls):
@@ -153,34 +171,131 @@ class Mapping(Base):
         return set(cls.get_decisions().keys())
 
     @classmethod
-    def generate_scored_mappings(cls, origins=[], threshold=.5):
-        """Do a cross-product comparison of entities and generate mappings."""
-        index = EntityIndex()
-        index.build()
+    def get_decided_check(cls):
+        """Return a function which checks in constant time whether a pair
+        of entities has been decided, directly or via a cluster."""
+        cls.update_clusters()
+        canonical = Cluster.get_canonical_uids()
+        q = session.query(cls.left_uid, cls.right_uid)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.decided == True)  # noqa
+        decided = set(q.yield_per(10000))
+
+        def is_decided(uida, uidb):
+            if cls.sort_uids(uida, uidb) in decided:
+                return True
+            canonical_uid = canonical.get(uida)
+            return canonical_uid is not None and \
+                canonical_uid == canonical.get(uidb)
+        return is_decided
+
+    @classmethod
+    def save_generated(cls, scored):
+        """Bulk write generated candidates from ``(uida, uidb, score)``
+        tuples. Decided pairs must be filtered out beforehand."""
+        rows = {}
+        for (uida, uidb, score) in scored:
+            if uida == uidb:
+                continue
+            left_uid, right_uid = cls.sort_uids(uida, uidb)
+            rows[(left_uid, right_uid)] = float(score)
+        if not len(rows):
+            return 0
+
+        existing = set()
+        lefts = list(set([l for (l, r) in rows.keys()]))
+        for i in range(0, len(lefts), 1000):
+            q = session.query(cls.left_uid, cls.right_uid)
+            q = q.filter(cls.left_uid.in_(lefts[i:i + 1000]))
+            for pair in q:
+                if pair in rows:
+                    existing.add(pair)
+
+        inserts, updates = [], []
+        for (left_uid, right_uid), score in rows.items():
+            row = {
+                'left_uid': left_uid,
+                'right_uid': right_uid,
+                'score': score,
+                'generated': True
+            }
+            if (left_uid, right_uid) in existing:
+                updates.append(row)
+            else:
+                row['project'] = project.name
+                row['decided'] = False
+                inserts.append(row)
+        session.bulk_insert_mappings(cls, inserts)
+        session.bulk_update_mappings(cls, updates)
+        return len(rows)
+
+    @classmethod
+    def generate_scored_mappings(cls, origins=[], threshold=.5,
+                                 blockers=None, max_block_size=200,
+                                 batch_size=10000, workers=1):
+        """Compare entities which share a blocking key and generate
+        mappings for the similar ones."""
         q = Entity.find_by_origins(origins=[])
         q = q.filter(Entity.active == True)  # noqa
-        entities = {e.uid: e for e in q.all()}
-        decided = cls.get_decided()
-        for entity in entities.values():
-            if len(origins) and entity.origin not in origins:
+        # Result contexts can repeat an entity under the same uid.
+        entities = {e.uid: e for e in q}.values()
+        is_decided = cls.get_decided_check()
+
+        include = None
+        if len(origins):
+            include = lambda e: e.origin in origins  # noqa
+
+        pairs = generate_pairs(entities, get_blockers(blockers),
+                               max_block_size=max_block_size,
+                               include=include)
+        # Committing expires the ORM entities, so they are not used once
+        # the first pair has been generated.
+        features = [e.features for e in entities]
+        pairs = ((features[i], features[j]) for (i, j) in pairs
+                 if not is_decided(features[i][0], features[j][0]))
+        compared, scored = 0, []
+        for count, batch in score_pairs(pairs, threshold=threshold,
+                                        workers=workers,
+                                        batch_size=batch_size):
+            compared += count
+            scored.extend(batch)
+            if len(scored) >= batch_size:
+                cls._flush_generated(scored, compared)
+                scored = []
+        cls._flush_generated(scored, compared)
+
+    @classmethod
+    def _flush_generated(cls, scored, compared):
+        count = cls.save_generated(scored)
+        session.commit()
+        project.log.info("Compared %d pairs, saved %d candidates.",
+                         compared, count)
+
+    @classmethod
+    def generate_indexed_mappings(cls, origins=[], threshold=.5):
+        """Query a full-text index for each entity and generate mappings
+        for the similar results."""
+        index = EntityIndex(project.data_path('index'))
+        index.update()
+        is_decided = cls.get_decided_check()
+        q = Entity.find_by_origins(origins=origins)
+        q = q.filter(Entity.active == True)  # noqa
+        for entity in q.yield_per(1000):
+            uids = [u for u in index.search_similar(entity)
+                    if not is_decided(entity.uid, u)]
+            if not len(uids):
                 continue
-            skip = set()
-            for pair in decided:
-                if entity.uid in pair:
-                    skip.update(pair)
-
-            for uid in index.search_similar(entity, skip=skip):
-                match = entities.get(uid)
-                score = entity.compare(match)
+            scored = []
+            matches = Entity.find_by_uids(uids)
+            matches = matches.filter(Entity.active == True).all()  # noqa
+            for match, score in zip(matches, compare_many(entity, matches)):
                 if score <= threshold:
                     continue
-
                 project.log.info("Candidate [%.3f]: %s <-> %s",
                                  score, entity.name, match.name)
-                cls.save(entity.uid, match.uid, judgement=None,
-                         score=score, generated=True)
-                decided.add((entity.uid, match.uid))
-                session.commit()
+                scored.append((entity.uid, match.uid, float(score)))
+            cls.save_generated(scored)
+        session.commit()
 
     @classmethod
     def cleanup(cls):
@@ -192,40 +307,74 @@ class Mapping(Base):
         q.delete(synchronize_session='fetch')
 
     @classmethod
-    def canonicalize(cls):
+    def canonical_version(cls):
+        """Identify the state of clusters, entities and links which
+        canonicalization depends on. New rows always get a higher ID."""
+        entity_id = session.query(func.max(Entity.id))
+        entity_id = entity_id.filter(Entity.project == project.name)
+        link_id = session.query(func.max(Link.id))
+        link_id = link_id.filter(Link.project == project.name)
+        return u'%s:%s:%s' % (Cluster.version(), entity_id.scalar(),
+                              link_id.scalar())
+
+    @classmethod
+    def canonicalize(cls, rebuild=False, force=False):
         """Write out canonical_uids based on entity mappings."""
-        q = session.query(Entity)
-        q = q.filter(Entity.project == project.name)
-        q.update({Entity.canonical_uid: Entity.uid},
-                 synchronize_session='fetch')
-
-        q = session.query(Link)
-        q = q.filter(Link.project == project.name)
-        q.update({Link.source_canonical_uid: Link.source_uid},
-                 synchronize_session='fetch')
-        q.update({Link.target_canonical_uid: Link.target_uid},
-                 synchronize_session='fetch')
-
-        clusters = cls.generate_clusters()
-        project.log.info("Canonicalize: %d clusters", len(clusters))
-        for uids in clusters:
-            canonical_uid = max(uids)
-            q = session.query(Entity)
-            q = q.filter(Entity.project == project.name)
-            q = q.filter(Entity.uid.in_(uids))
-            q.update({Entity.canonical_uid: canonical_uid},
-                     synchronize_session='fetch')
-
-            q = session.query(Link)
-            q = q.filter(Link.project == project.name)
-            q = q.filter(Link.source_uid.in_(uids))
-            q.update({Link.source_canonical_uid: canonical_uid},
-                     synchronize_session='fetch')
-            q = session.query(Link)
-            q = q.filter(Link.project == project.name)
-            q = q.filter(Link.target_uid.in_(uids))
-            q.update({Link.target_canonical_uid: canonical_uid},
-                     synchronize_session='fetch')
+        cls.update_clusters(rebuild=rebuild)
+        version = cls.canonical_version()
+        if not force and State.get(CANONICAL_KEY) == version:
+            project.log.info("Canonicalize: no changes.")
+            return
+
+        updated = 0
+        columns = [
+            (Entity.__table__, 'uid', 'canonical_uid'),
+            (Link.__table__, 'source_uid', 'source_canonical_uid'),
+            (Link.__table__, 'target_uid', 'target_canonical_uid'),
+        ]
+        for table, uid_column, canonical_column in columns:
+            updated += cls._canonicalize_column(table,
+                                                table.c[uid_column],
+                                                table.c[canonical_column])
+        project.log.info("Canonicalize: %d rows updated.", updated)
+        session.expire_all()
+        State.set(CANONICAL_KEY, version)
+
+    @classmethod
+    def _canonicalize_column(cls, table, uid_column, canonical_column):
+        """Rewrite one canonical UID column with set-based updates, only
+        touching rows where the value changes."""
+        clusters = Cluster.__table__
+        members = select([clusters.c.uid])
+        members = members.where(clusters.c.project == project.name)
+
+        # Entities which are not in any cluster are their own canonical.
+        stmt = table.update()
+        stmt = stmt.where(table.c.project == project.name)
+        stmt = stmt.where(~uid_column.in_(members))
+        stmt = stmt.where(or_(canonical_column == None,  # noqa
+                              canonical_column != uid_column))
+        stmt = stmt.values({canonical_column: uid_column})
+        updated = session.execute(stmt).rowcount
+
+        stmt = table.update()
+        stmt = stmt.where(table.c.project == project.name)
+        if session.get_bind().dialect.name == 'postgresql':
+            # UPDATE ... FROM cluster
+            canonical_uid = clusters.c.canonical_uid
+            stmt = stmt.where(clusters.c.project == project.name)
+            stmt = stmt.where(clusters.c.uid == uid_column)
+            stmt = stmt.where(or_(canonical_column == None,  # noqa
+                                  canonical_column != canonical_uid))
+            stmt = stmt.values({canonical_column: canonical_uid})
+        else:
+            canonical = select([clusters.c.canonical_uid])
+            canonical = canonical.where(clusters.c.project == project.name)
+            canonical = canonical.where(clusters.c.uid == uid_column)
+            stmt = stmt.where(uid_column.in_(members))
+            stmt = stmt.values({canonical_column: canonical.as_scalar()})
+        updated += session.execute(stmt).rowcount
+        return updated
 
     @classmethod
     def find_undecided(cls, limit=10, offset=0):
@@ -1,7 +1,8 @@
 import logging
+from os import path
 from normality import stringify
 
-from corpint.core import session
+from corpint.core import session, config
 from corpint.model.emitter import OriginEmitter
 from corpint.model.mapping import Mapping
 
@@ -13,6 +14,10 @@ class Project(object):
         self.name = stringify(name)
         self.log = logging.getLogger(self.name)
 
+    def data_path(self, *parts):
+        """Local working directory for this project, e.g. for indexes."""
+        return path.join(config.data_path, self.name, *parts)
+
     def origin(self, name):
         return OriginEmitter(name)
 
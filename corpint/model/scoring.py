@@ -0,0 +1,128 @@
+import logging
+import Levenshtein
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
+
+from corpint.model.schema import ASSET, PERSON, BANK_ACCOUNT
+
+log = logging.getLogger(__name__)
+
+
+def compare_pairs(pairs):
+    """Score a list of ``(left, right)`` entity ``features`` at once.
+
+    This returns an array with exactly the values ``compare_features``
+    would give for each pair: the edit distances are computed once for
+    each pair of fingerprints, and the multipliers are applied in the
+    same order, on whole arrays."""
+    size = len(pairs)
+    if size == 0:
+        return np.zeros(0)
+
+    # Best fingerprint similarity of each pair.
+    positions, lfps, rfps = [], [], []
+    for idx, (left, right) in enumerate(pairs):
+        for lfp in left[1]:
+            for rfp in right[1]:
+                positions.append(idx)
+                lfps.append(lfp)
+                rfps.append(rfp)
+    base = np.zeros(size)
+    if len(positions):
+        cache = {}
+        distances = np.empty(len(positions))
+        for i, key in enumerate(zip(lfps, rfps)):
+            if key not in cache:
+                cache[key] = Levenshtein.distance(*key)
+            distances[i] = cache[key]
+        lengths = np.maximum([len(f) for f in lfps], [len(f) for f in rfps])
+        similarity = 1 - (distances / lengths.astype(np.float64))
+        np.maximum.at(base, np.array(positions), similarity)
+
+    excluded, person, country, regnr, untasked, same_id = \
+        [np.zeros(size, dtype=bool) for _ in range(6)]
+    for idx, (left, right) in enumerate(pairs):
+        (_, _, lcountry, lschema, ltasked, lids, lregnr, _) = left
+        (_, _, rcountry, rschema, rtasked, _, rregnr, rid) = right
+        same_id[idx] = any([l is not None and l == rid for l in lids])
+        excluded[idx] = lschema in (BANK_ACCOUNT, ASSET) or \
+            rschema in (BANK_ACCOUNT, ASSET)
+        person[idx] = PERSON in (lschema, rschema)
+        country[idx] = lcountry is not None and lcountry == rcountry
+        regnr[idx] = lregnr is not None and lregnr == rregnr
+        untasked[idx] = not ltasked and not rtasked
+
+    scores = base * np.where(person, 1.0, .95)
+    scores = scores * np.where(country, 1.0, .95)
+    scores = scores * np.where(regnr, 1.1, 1.0)
+    scores = scores * np.where(untasked, .95, 1.0)
+    scores = np.minimum(1.0, scores)
+    scores[excluded] = 0.0
+    scores[same_id] = 2.0
+    return scores
+
+
+def compare_many(entity, candidates):
+    """Score one entity against a list of candidate entities."""
+    features = entity.features
+    return compare_pairs([(features, c.features) for c in candidates])
+
+
+def score_batch(args):
+    """Score a list of ``(left, right)`` feature pairs, keeping only those
+    above the threshold. Runs inside the worker processes."""
+    threshold, pairs = args
+    scores = compare_pairs(pairs)
+    scored = []
+    for idx in np.flatnonzero(scores > threshold):
+        left, right = pairs[idx]
+        scored.append((left[0], right[0], float(scores[idx])))
+    return len(pairs), scored
+
+
+def feature_batches(pairs, threshold, batch_size):
+    batch = []
+    for left, right in pairs:
+        batch.append((left, right))
+        if len(batch) >= batch_size:
+            yield threshold, batch
+            batch = []
+    if len(batch):
+        yield threshold, batch
+
+
+def get_result(result):
+    # Wait with a timeout so that Ctrl-C is delivered.
+    while not result.ready():
+        result.wait(0.5)
+    return result.get()
+
+
+def score_pairs(pairs, threshold=.5, workers=1, batch_size=10000):
+    """Score pairs of entity ``features``, optionally in a pool of worker
+    processes. Yields a ``(compared, scored)`` tuple for each batch."""
+    batches = feature_batches(pairs, threshold, batch_size)
+    if workers <= 1:
+        for batch in batches:
+            yield score_batch(batch)
+        return
+
+    log.info("Scoring with %d worker processes.", workers)
+    pool = Pool(workers)
+    pending = deque()
+    try:
+        # Batches are built in this thread, and only a few are submitted
+        # ahead of the results, so that memory use stays bounded.
+        for batch in batches:
+            pending.append(pool.apply_async(score_batch, (batch,)))
+            if len(pending) >= workers * 2:
+                yield get_result(pending.popleft())
+        while len(pending):
+            yield get_result(pending.popleft())
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,61 @@
+from sqlalchemy import Column, Unicode, Integer, cast, and_
+from sqlalchemy.dialects.postgresql import insert
+
+from corpint.core import session, project
+from corpint.model.common import Base
+
+
+class State(Base):
+    """Per-project bookkeeping values, e.g. build flags and watermarks."""
+    __tablename__ = 'state'
+
+    project = Column(Unicode(255), primary_key=True)
+    key = Column(Unicode(255), primary_key=True)
+    value = Column(Unicode(), nullable=True)
+
+    @classmethod
+    def get(cls, key, default=None):
+        # Not from the identity map, since ``increment`` bypasses it.
+        q = session.query(cls.value)
+        q = q.filter(cls.project == project.name)
+        q = q.filter(cls.key == key)
+        value = q.scalar()
+        if value is None:
+            return default
+        return value
+
+    @classmethod
+    def set(cls, key, value):
+        obj = session.query(cls).get((project.name, key))
+        if obj is None:
+            obj = cls()
+            obj.project = project.name
+            obj.key = key
+        obj.value = value
+        session.add(obj)
+        return obj
+
+    @classmethod
+    def increment(cls, key):
+        """Add one to a counter in a single statement, so that concurrent
+        writers do not lose updates."""
+        table = cls.__table__
+        value = cast(cast(table.c.value, Integer) + 1, Unicode)
+        if session.get_bind().dialect.name == 'postgresql':
+            stmt = insert(table).values(project=project.name, key=key,
+                                        value=u'1')
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.project, table.c.key],
+                set_={'value': value}
+            )
+            session.execute(stmt)
+            return
+        stmt = table.update().values(value=value)
+        stmt = stmt.where(and_(table.c.project == project.name,
+                               table.c.key == key))
+        if session.execute(stmt).rowcount == 0:
+            session.execute(table.insert().values(project=project.name,
+                                                  key=key, value=u'1'))
+
+    def __repr__(self):
+        return '<State(%r, %r)>' % (self.key, self.value)
@@ -0,0 +1,101 @@
+import logging
+from sqlalchemy import text, select, bindparam
+
+from corpint.model.entity import Entity
+
+log = logging.getLogger(__name__)
+
+
+def index_exists(conn, name):
+    return conn.execute(text("SELECT to_regclass(:name)"),
+                        name=name).scalar() is not None
+
+
+def count_duplicate_entities(conn):
+    return conn.execute(text("""SELECT COUNT(*) FROM (SELECT 1 FROM entity
+        GROUP BY project, uid, COALESCE(query_uid, ''),
+        COALESCE(match_uid, '') HAVING COUNT(*) > 1) AS d""")).scalar()
+
+
+def upgrade_result_uid_index(conn, dedupe=False):
+    """Add the unique index which ``Entity.save_many`` upserts against.
+    Older databases can have duplicate rows for it, which are only
+    removed with ``dedupe`` (keeping the latest one)."""
+    if index_exists(conn, 'ix_entity_result_uid'):
+        return
+    if dedupe:
+        res = conn.execute(text("""DELETE FROM entity e USING entity d
+            WHERE e.project = d.project AND e.uid = d.uid
+            AND COALESCE(e.query_uid, '') = COALESCE(d.query_uid, '')
+            AND COALESCE(e.match_uid, '') = COALESCE(d.match_uid, '')
+            AND e.id < d.id"""))
+        log.info("Upgrade: removed %d duplicate entities.", res.rowcount)
+    else:
+        duplicates = count_duplicate_entities(conn)
+        if duplicates > 0:
+            log.warning("%d entities have duplicate rows, so bulk saving "
+                        "will fail. Run 'corpint upgrade' to remove them.",
+                        duplicates)
+            return
+    conn.execute(text("""CREATE UNIQUE INDEX IF NOT EXISTS
+        ix_entity_result_uid ON entity (project, uid,
+        COALESCE(query_uid, ''), COALESCE(match_uid, ''))"""))
+
+
+def upgrade_updated_at(conn):
+    """Add ``entity.updated_at``. Existing rows get the time of the
+    upgrade, so that the search index picks them up."""
+    conn.execute(text("""ALTER TABLE entity
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE"""))
+    conn.execute(text("""UPDATE entity SET updated_at = timezone('utc', now())
+        WHERE updated_at IS NULL"""))
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_entity_updated_at
+        ON entity (updated_at)"""))
+
+
+def column_exists(conn, table, column):
+    q = text("""SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_name = :table AND column_name = :column""")
+    return conn.execute(q, table=table, column=column).scalar() > 0
+
+
+def upgrade_name_fingerprints(conn, chunk_size=10000):
+    """Add ``entity.name_fingerprints`` and its index, and fill it in for
+    the existing rows."""
+    if column_exists(conn, 'entity', 'name_fingerprints'):
+        return
+    conn.execute(text("""ALTER TABLE entity
+        ADD COLUMN IF NOT EXISTS name_fingerprints VARCHAR[]"""))
+    table = Entity.__table__
+    stmt = table.update().where(table.c.id == bindparam('_id'))
+    stmt = stmt.values(name_fingerprints=bindparam('_fps'))
+    last_id, total = 0, 0
+    while True:
+        q = select([table.c.id, table.c.data])
+        q = q.where(table.c.id > last_id).order_by(table.c.id)
+        rows = conn.execute(q.limit(chunk_size)).fetchall()
+        if not len(rows):
+            break
+        conn.execute(stmt, [{
+            '_id': id_,
+            '_fps': Entity.generate_fingerprints(data or {})
+        } for (id_, data) in rows])
+        last_id = rows[-1][0]
+        total += len(rows)
+        log.info("Upgrade: fingerprinted %d entities.", total)
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS
+        ix_entity_name_fingerprints ON entity
+        USING gin (name_fingerprints)"""))
+
+
+def upgrade_database(engine, dedupe=False):
+    """Bring the tables of an existing database up to date with the model,
+    since ``create_all`` only creates missing tables. Each step checks
+    whether it is needed, so this can run on every start. Rows are only
+    deleted with ``dedupe``, from ``corpint upgrade``."""
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as conn:
+        upgrade_result_uid_index(conn, dedupe=dedupe)
+        upgrade_updated_at(conn)
+        upgrade_name_fingerprints(conn)
@@ -31,12 +31,14 @@ setup(
         'whoosh',  # search based de-dupe
         'googlemaps',
         'python-Levenshtein',
+        'numpy',  # batch scoring
         'mwclient',  # wikipedia
         'rdflib',  # wikidata
         'SPARQLWrapper',  # wikidata
         'zeep',  # bvd orbis (soap)
         'urlnorm',  # document crawler
         'py2neo',
+        'pyarrow',  # parquet export
         'click',
         'Flask'
     ],